@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+###
+# Benchmark the throughput and memory use of PlasClass, and compare against a baseline
+###
+
+from plasclass import plasclass_utils as utils
+from plasclass import plasclass
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# the range of sequence lengths generated for each model length scale
+SCALE_LENGTHS = {1000: (500, 5500), 10000: (5500, 55000), 100000: (55000, 300000), 500000: (300000, 700000)}
+
+# run in a new interpreter to time importing plasclass, constructing a classifier and classifying a 1 kb sequence
+STARTUP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+from plasclass import plasclass
+imported = time.perf_counter()
+c = plasclass.plasclass()
+constructed = time.perf_counter()
+c.classify('ACGT' * 250)
+classified = time.perf_counter()
+from benchmark import peak_rss_mb
+print(json.dumps({'seconds': [imported - start, constructed - imported, classified - constructed], 'peak_rss_mb': peak_rss_mb()}))
+'''
+
+def parse_user_input():
+
+    parser = argparse.ArgumentParser(
+        description=
+        'benchmark measures the throughput, memory use and parallel scaling of PlasClass on synthetic sequences',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('-o','--outfile',
+     help='file to save the results to, as JSON',
+     required=False, type=str, default='benchmark.json'
+        )
+    parser.add_argument('-p','--num_processes',
+     help='comma-separated list of the numbers of processes to benchmark',
+     required=False, type=str, default='1,2,4'
+        )
+    parser.add_argument('-n','--num_seqs',
+     help='comma-separated numbers of sequences to generate at each length scale (1k,10k,100k,500k)',
+     required=False, type=str, default='2000,200,20,4'
+        )
+    parser.add_argument('--n_content',
+     help='fraction of the generated bases that are N, in runs of 50',
+     required=False, type=float, default=0.01
+        )
+    parser.add_argument('--seed',
+     help='random seed of the generated sequences',
+     required=False, type=int, default=0
+        )
+    parser.add_argument('-f','--fasta',
+     help='benchmark on this fasta file instead of generating one',
+     required=False, type=str
+        )
+    parser.add_argument('-r','--repeat',
+     help='number of times each benchmark is run; the fastest run is reported',
+     required=False, type=int, default=3
+        )
+    parser.add_argument('-b','--baseline',
+     help='results of an earlier run to compare against',
+     required=False, type=str
+        )
+    parser.add_argument('-t','--threshold',
+     help='fail if a throughput is this fraction below the baseline',
+     required=False, type=float, default=0.2
+        )
+    parser.add_argument('--run',
+     help=argparse.SUPPRESS, # internal: run the named benchmark on --fasta and print its result as JSON
+     required=False, type=str, choices=BENCHMARKS + ['classify_fasta']
+        )
+
+    return parser.parse_args()
+
+
+def make_fasta(path, num_seqs, n_content=0.01, seed=0):
+    ''' Write a fasta file of random sequences, num_seqs[s] of them at each length scale s
+        Lengths are log-uniform over the range of the scale (SCALE_LENGTHS) and about a fraction
+        n_content of the bases are N, in runs of 50. The records are in random order
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = np.concatenate([np.exp(rng.uniform(np.log(SCALE_LENGTHS[s][0]), np.log(SCALE_LENGTHS[s][1]), n))
+                              for s, n in num_seqs.items()]).astype(np.int64)
+    rng.shuffle(lengths)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    with open(path, 'w') as f:
+        for i, length in enumerate(lengths):
+            seq = rng.choice(bases, length)
+            n_runs = rng.binomial(length // 50, n_content)
+            for start in rng.integers(0, max(length - 50, 1), n_runs):
+                seq[start:start+50] = ord('N')
+            seq = seq.tobytes().decode()
+            f.write('>seq{} length={}\n'.format(i, length))
+            for j in range(0, length, 80):
+                f.write(seq[j:j+80] + '\n')
+
+
+def peak_rss_mb():
+    ''' Peak resident set size of this process, or of the largest of the children it reaped
+        (the workers of a closed pool), in megabytes
+        On Linux the ru_maxrss of a new process also counts the process that started it, so its own
+        peak is read from VmHWM instead
+    '''
+    scale = 1. if sys.platform == 'darwin' else 1024. # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    try:
+        with open('/proc/self/status') as f:
+            self_rss = int(f.read().split('VmHWM:')[1].split()[0]) * 1024.
+    except (OSError, IndexError, ValueError):
+        pass
+    return max(self_rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale) / 2**20
+
+
+def run_measured(cmd):
+    ''' Run cmd in a new process with plasclass and this module importable, and return the JSON
+        it prints last, which includes its peak_rss_mb
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [root, os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([p for p in paths if p]))
+    output = subprocess.check_output(cmd, env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def timed(func, repeat):
+    ''' The fastest of repeat calls of func, with the output of PlasClass suppressed
+    '''
+    best = float('inf')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(name, seconds, bases, n_seqs, n_procs=None, peak_rss=None):
+    return {'name': name, 'n_procs': n_procs, 'seconds': seconds, 'bases': int(bases), 'sequences': int(n_seqs),
+            'bases_per_sec': bases / seconds, 'sequences_per_sec': n_seqs / seconds, 'peak_rss_mb': peak_rss}
+
+
+def bench_parsing(fasta, repeat, name):
+    ''' Time reading the fasta file with readfq or read_fastx (name)
+    '''
+    def parse_readfq():
+        with open(fasta) as f:
+            for _ in utils.readfq(f): pass
+    def parse_read_fastx():
+        for _ in utils.read_fastx(fasta): pass
+    lengths = [len(seq) for _, seq, _ in utils.read_fastx(fasta)]
+    parse = parse_readfq if name == 'readfq' else parse_read_fastx
+    return result(name, timed(parse, repeat), sum(lengths), len(lengths))
+
+
+def bench_startup(repeat):
+    ''' Time starting up: importing plasclass, constructing a classifier and classifying a 1 kb
+        sequence in a new interpreter, as a short job does
+    '''
+    best, peak_rss = None, 0.
+    for _ in range(repeat):
+        output = run_measured([sys.executable, '-c', STARTUP_SCRIPT])
+        times = output['seconds']
+        peak_rss = max(peak_rss, output['peak_rss_mb'])
+        if best is None or sum(times) < sum(best):
+            best = times
+    r = result('startup', sum(best), 1000, 1, peak_rss=peak_rss)
+    r.update({'import_seconds': best[0], 'construct_seconds': best[1], 'first_classify_seconds': best[2]})
+    return [r]
+
+
+def bench_kernels(c, seqs, repeat, name):
+    ''' Time counting the k-mers of each sequence (count_kmers) or scoring the frequencies
+        of each length scale (standardize, and the fused standardize and predict_proba)
+    '''
+    bases = sum([len(s) for s in seqs])
+    kmer_freqs = [0] * len(seqs)
+    def count():
+        for i, seq in enumerate(seqs):
+            utils.count_kmers([i, seq, c._ks, c._kmer_inds, c._kmer_count_lens, kmer_freqs])
+    if name == 'count_kmers':
+        return result(name, timed(count, repeat), bases, len(seqs))
+    count()
+
+    scales = np.array([c._get_scale(len(s)) for s in seqs])
+    kmer_freqs = np.array(kmer_freqs)
+    partitions = [(scale, kmer_freqs[scales == scale]) for scale in c._scales if (scales == scale).any()]
+    def standardize():
+        for scale, freqs in partitions:
+            c._standardize(freqs, scale)
+    def score():
+        for scale, freqs in partitions:
+            c._score(freqs, scale)
+    return result(name, timed(standardize if name == 'standardize' else score, repeat), bases, len(seqs))
+
+
+def bench_classify_single(c, seqs, repeat):
+    ''' Time the classify API on single sequences, a few of each length scale
+    '''
+    by_scale = {}
+    for seq in seqs:
+        by_scale.setdefault(c._get_scale(len(seq)), []).append(seq)
+    singles = [s for scale_seqs in by_scale.values() for s in scale_seqs[:5]]
+    return result('classify_single', timed(lambda: [c.classify(s) for s in singles], repeat),
+                  sum([len(s) for s in singles]), len(singles))
+
+
+def bench_classify(seqs, n_procs, repeat, name):
+    ''' Time the classify API on the list of all sequences (classify_list), or streaming them (classify_stream)
+        The worker pool is started before timing, and closed before returning
+    '''
+    bases = sum([len(s) for s in seqs])
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        c = plasclass.plasclass(n_procs)
+        c.classify(seqs[:1])
+    with c:
+        if name == 'classify_list':
+            return result(name, timed(lambda: c.classify(seqs), repeat), bases, len(seqs), n_procs)
+        return result(name, timed(lambda: list(c.classify_stream(iter(enumerate(seqs)))), repeat), bases, len(seqs), n_procs)
+
+
+# the benchmarks run in their own process by bench_isolated, those taking a number of processes last
+BENCHMARKS = ['readfq', 'read_fastx', 'count_kmers', 'standardize', 'standardize_predict_proba', 'classify_single',
+              'classify_list', 'classify_stream']
+
+
+def run_benchmark(name, fasta, n_procs, repeat, outfile=None):
+    ''' Run one of BENCHMARKS on the sequences of fasta in this process, or classify_fasta.py once
+        on fasta with its results written to outfile, and return the result with the peak resident set size
+    '''
+    if name == 'classify_fasta':
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'classify_fasta.py')
+        sys.argv = [script, '-f', fasta, '-o', outfile, '-p', str(n_procs)]
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            runpy.run_path(script, run_name='__main__')
+        return {'name': name, 'peak_rss_mb': peak_rss_mb()}
+    r = _run_benchmark(name, fasta, n_procs, repeat)
+    r['peak_rss_mb'] = peak_rss_mb()
+    return r
+
+
+def _run_benchmark(name, fasta, n_procs, repeat):
+    if name in ['readfq', 'read_fastx']:
+        return bench_parsing(fasta, repeat, name)
+    seqs = [seq for _, seq, _ in utils.readfq(open(fasta))]
+    if name in ['classify_list', 'classify_stream']:
+        return bench_classify(seqs, n_procs, repeat, name)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        c = plasclass.plasclass()
+    if name == 'classify_single':
+        return bench_classify_single(c, seqs, repeat)
+    return bench_kernels(c, seqs, repeat, name)
+
+
+def bench_isolated(name, fasta, n_procs, repeat):
+    ''' Run one of BENCHMARKS in a new process, so that its peak resident set size (including
+        its workers) is its own rather than the high-water mark of the earlier benchmarks
+    '''
+    return run_measured([sys.executable, os.path.abspath(__file__), '--run', name, '-f', fasta,
+                         '-p', str(n_procs), '-r', str(repeat)])
+
+
+def bench_classify_fasta(fasta, bases, n_seqs, n_procs, repeat):
+    ''' Time classify_fasta.py end to end, with the peak resident set size of the process and its workers
+    '''
+    fd, outfile = tempfile.mkstemp(suffix='.probs.out')
+    os.close(fd)
+    best, peak_rss = float('inf'), 0.
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = run_measured([sys.executable, os.path.abspath(__file__), '--run', 'classify_fasta', '-f', fasta,
+                                   '-o', outfile, '-p', str(n_procs)])
+            best = min(best, time.perf_counter() - start)
+            peak_rss = max(peak_rss, output['peak_rss_mb'])
+    finally:
+        os.remove(outfile)
+    return result('classify_fasta', best, bases, n_seqs, n_procs, peak_rss)
+
+
+def add_scaling_efficiency(results):
+    ''' Add the parallel efficiency of each result relative to the run of the same benchmark
+        with the fewest processes: t_min * p_min / (t * p)
+    '''
+    fewest = {}
+    for r in results:
+        if r['n_procs'] is None: continue
+        if r['name'] not in fewest or r['n_procs'] < fewest[r['name']]['n_procs']:
+            fewest[r['name']] = r
+    for r in results:
+        if r['n_procs'] is None: continue
+        base = fewest[r['name']]
+        r['scaling_efficiency'] = base['seconds'] * base['n_procs'] / (r['seconds'] * r['n_procs'])
+
+
+def compare(results, baseline, threshold):
+    ''' Compare the throughputs with the baseline results
+        Returns the comparisons (name, n_procs, baseline bases/s, bases/s, ratio) and the regressions,
+        those more than threshold below the baseline
+    '''
+    base = {(r['name'], r['n_procs']): r for r in baseline['results']}
+    comparisons = []
+    for r in results:
+        key = (r['name'], r['n_procs'])
+        if key not in base: continue
+        ratio = r['bases_per_sec'] / base[key]['bases_per_sec']
+        comparisons.append((r['name'], r['n_procs'], base[key]['bases_per_sec'], r['bases_per_sec'], ratio))
+    regressions = [c for c in comparisons if c[-1] < 1. - threshold]
+    return comparisons, regressions
+
+
+def print_results(results):
+    print('{:<28}{:>8}{:>12}{:>14}{:>12}{:>12}'.format('benchmark', 'procs', 'seconds', 'Mbases/s', 'peak MB', 'efficiency'))
+    for r in results:
+        print('{:<28}{:>8}{:>12.3f}{:>14.2f}{:>12.1f}{:>12}'.format(
+            r['name'], r['n_procs'] if r['n_procs'] is not None else '-', r['seconds'], r['bases_per_sec'] / 1e6,
+            r['peak_rss_mb'], '{:.2f}'.format(r['scaling_efficiency']) if 'scaling_efficiency' in r else '-'))
+
+
+def main(args):
+    ''' Run the benchmarks, save the results and compare them with the baseline
+    '''
+    if args.run:
+        print(json.dumps(run_benchmark(args.run, args.fasta, int(args.num_processes), args.repeat, args.outfile)))
+        return
+    n_procs = [int(p) for p in args.num_processes.split(',')]
+    config = {'num_processes': n_procs, 'repeat': args.repeat}
+    fasta = args.fasta
+    tmpdir = None
+    if fasta is None:
+        num_seqs = dict(zip(sorted(SCALE_LENGTHS), [int(n) for n in args.num_seqs.split(',')]))
+        config.update({'num_seqs': num_seqs, 'n_content': args.n_content, 'seed': args.seed})
+        tmpdir = tempfile.mkdtemp(prefix='plasclass_benchmark_')
+        fasta = os.path.join(tmpdir, 'benchmark.fa')
+        print("Generating sequences")
+        make_fasta(fasta, num_seqs, args.n_content, args.seed)
+    else:
+        config['fasta'] = os.path.abspath(fasta)
+
+    try:
+        lengths = [len(seq) for _, seq, _ in utils.read_fastx(fasta)]
+        bases = sum(lengths)
+        print("Benchmarking on {} sequences, {} bases".format(len(lengths), bases))
+        print("Starting up")
+        results = bench_startup(args.repeat)
+        print("Parsing, counting and scoring")
+        results += [bench_isolated(name, fasta, 1, args.repeat) for name in BENCHMARKS[:-2]]
+        for p in n_procs:
+            print("Classifying with {} processes".format(p))
+            results += [bench_isolated(name, fasta, p, args.repeat) for name in BENCHMARKS[-2:]]
+            results.append(bench_classify_fasta(fasta, bases, len(lengths), p, args.repeat))
+    finally:
+        if tmpdir is not None:
+            os.remove(fasta)
+            os.rmdir(tmpdir)
+    add_scaling_efficiency(results)
+    print_results(results)
+
+    machine = {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'cpu_count': os.cpu_count()}
+    with open(args.outfile, 'w') as f:
+        json.dump({'machine': machine, 'config': config, 'results': results}, f, indent=1)
+    print("Saved results to {}".format(args.outfile))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparisons, regressions = compare(results, baseline, args.threshold)
+        print('{:<28}{:>8}{:>16}{:>16}{:>10}'.format('benchmark', 'procs', 'baseline Mb/s', 'Mbases/s', 'ratio'))
+        for name, p, base_rate, rate, ratio in comparisons:
+            print('{:<28}{:>8}{:>16.2f}{:>16.2f}{:>10.2f}'.format(name, p if p is not None else '-', base_rate / 1e6, rate / 1e6, ratio))
+        if regressions:
+            print("{} benchmarks are more than {:.0%} slower than the baseline".format(len(regressions), args.threshold))
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__=='__main__':
+    args = parse_user_input()
+    main(args)
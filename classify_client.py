@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+###
+# Provide a command line script to classify sequences in a fasta file with a running PlasClass server
+###
+
+from plasclass import server
+from plasclass import result_writer
+
+import argparse
+import json
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+OUTFILE_SUFFIXES = {'tsv': '.probs.out', 'tsv.gz': '.probs.out.gz', 'binary': '.probs'}
+
+def parse_user_input():
+
+    parser = argparse.ArgumentParser(
+        description=
+        'classify_client classifies the sequences in a fasta file as plasmid origin or not '
+        'with a running PlasClass server (python -m plasclass.server)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('-f','--fasta',
+     help='fasta file of the sequences to be classified',
+     required=True, type=str
+        )
+    parser.add_argument('-o','--outfile',
+     help='output file prefix',
+     required=False, type=str
+        )
+    parser.add_argument('-s','--socket',
+     help='Unix socket of the server, instead of HTTP on host and port',
+     required=False, type=str
+        )
+    parser.add_argument('--host',
+     help='host of the server',
+     required=False, type=str, default='127.0.0.1'
+        )
+    parser.add_argument('--port',
+     help='port of the server',
+     required=False, type=int, default=server.DEFAULT_PORT
+        )
+    parser.add_argument('--upload',
+     help='Send the contents of the fasta file instead of its path, for a server that cannot read the file',
+     action='store_true'
+        )
+    parser.add_argument('-p','--num_processes',
+     help='Ignored, the server uses its own processes',
+     required=False, type=int
+        )
+    parser.add_argument('--max_bases',
+     help='Ignored, the server batches requests by its own limit',
+     required=False, type=int
+        )
+    parser.add_argument('--cache',
+     help='Ignored, the cache is set when starting the server',
+     required=False, type=str
+        )
+    parser.add_argument('--cache_size',
+     help='Ignored, the cache is set when starting the server',
+     required=False, type=int
+        )
+    parser.add_argument('--precision',
+     help='Ignored, the precision is set when starting the server',
+     required=False, type=str, choices=['float64', 'float32']
+        )
+    parser.add_argument('--window',
+     help='Score windows of this length along each sequence instead of whole sequences, '
+          'writing a bedGraph of the window scores',
+     required=False, type=int
+        )
+    parser.add_argument('--step',
+     help='Step between the starts of consecutive windows (default: the window length)',
+     required=False, type=int
+        )
+    parser.add_argument('--format',
+     help='Output format: tab separated lines, gzip compressed tab separated lines, or binary columns '
+          '(<outfile>.names, and the float32 scores in <outfile>.probs.npy, which can be memory-mapped)',
+     required=False, type=str, choices=result_writer.FORMATS, default='tsv'
+        )
+    parser.add_argument('--digits',
+     help='Significant digits of the scores in text output (default: as many as needed to read back the same score)',
+     required=False, type=int
+        )
+    parser.add_argument('--columns',
+     help='Comma separated extra output columns: length (of the sequence) and scale (the length scale of the '
+          'model that scored it)',
+     required=False, type=str
+        )
+    parser.add_argument('--metrics_json','--metrics-json',
+     help="Save the server's metrics (of all the requests it has served) to this JSON file",
+     required=False, type=str
+        )
+
+    return parser.parse_args()
+
+
+def main(args):
+    ''' Main function that classifies the sequences with the server
+    '''
+    infile = args.fasta
+    if args.outfile: outfile = args.outfile
+    else: outfile = infile + OUTFILE_SUFFIXES[args.format]
+    columns = args.columns.split(',') if args.columns else []
+    for column in columns:
+        if column not in result_writer.COLUMNS:
+            sys.exit('Unknown column {}, not one of {}'.format(column, ','.join(result_writer.COLUMNS)))
+    if args.window and (args.format != 'tsv' or args.digits is not None or args.columns):
+        sys.exit('--format, --digits and --columns apply to sequence scores, not to --window')
+
+    logger.info("Classifying %s", infile)
+    conn = {'socket_path': args.socket, 'host': args.host, 'port': args.port}
+    options = {'columns': columns, 'window': args.window, 'step': args.step}
+    try:
+        if args.upload:
+            with open(infile,'rb') as f:
+                scores = server.classify_remote(data=f.read(), **options, **conn)
+        else:
+            scores = server.classify_remote(infile, **options, **conn)
+        metrics = server.request('GET', '/metrics', **conn) if args.metrics_json else None
+    except (OSError, RuntimeError) as e:
+        sys.exit('Classification failed: {}'.format(e))
+    if args.window:
+        with open(outfile,'wb') as o:
+            o.write(scores)
+    else:
+        write_scores(scores, outfile, args.format, args.digits, columns)
+    if metrics is not None:
+        with open(args.metrics_json,'w') as f:
+            json.dump(json.loads(metrics.decode()), f, indent=1)
+    logger.info("Finished classifying")
+    logger.info("Class scores written in: %s", outfile)
+
+
+def write_scores(scores, outfile, format, digits, columns):
+    ''' Write the score lines returned by the server to outfile in the output format
+    '''
+    with result_writer.ResultWriter(outfile, format, digits, columns) as write:
+        for line in scores.decode().splitlines():
+            fields = line.split('\t')
+            write.add(fields[0], float(fields[1]), *[int(v) for v in fields[2:]])
+
+
+if __name__=='__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+    main(parse_user_input())
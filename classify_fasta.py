@@ -5,9 +5,22 @@
 
 from plasclass import plasclass_utils as utils
 from plasclass import plasclass
+from plasclass import metrics
+from plasclass import feature_store
+from plasclass import result_writer
 
 import argparse
+import collections
+import json
+import logging
+import multiprocessing as mp
+import os
 import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+OUTFILE_SUFFIXES = {'tsv': '.probs.out', 'tsv.gz': '.probs.out.gz', 'binary': '.probs'}
 
 def parse_user_input():
 
@@ -18,7 +31,7 @@ def parse_user_input():
         )
     parser.add_argument('-f','--fasta',
      help='fasta file of the sequences to be classified',
-     required=True, type=str
+     required=False, type=str
         )
     parser.add_argument('-o','--outfile',
      help='output file prefix',
@@ -28,6 +41,76 @@ def parse_user_input():
      help='Number of processes to use',
      required=False, type=int, default=8
         )
+    parser.add_argument('--max_bases',
+     help='Maximum number of bases being classified at once, which bounds memory use',
+     required=False, type=int, default=100000000
+        )
+    parser.add_argument('--cache',
+     help='Directory of a persistent cache of results, so that sequences classified before are not counted again. '
+          'It holds the scores of whole sequences, so it cannot be used with --window',
+     required=False, type=str
+        )
+    parser.add_argument('--cache_size',
+     help='Maximum number of sequences in the cache, evicting the least recently used',
+     required=False, type=int, default=10000000
+        )
+    parser.add_argument('--window',
+     help='Score windows of this length along each sequence instead of whole sequences, '
+          'writing a bedGraph of the window scores',
+     required=False, type=int
+        )
+    parser.add_argument('--step',
+     help='Step between the starts of consecutive windows (default: the window length)',
+     required=False, type=int
+        )
+    parser.add_argument('--shard',
+     help='Only classify shard i of N (i/N, i from 1 to N), writing <outfile>.shard<i>of<N>. '
+          'Shards are byte ranges of the fasta file balanced by total sequence length',
+     required=False, type=str
+        )
+    parser.add_argument('--merge',
+     help='Merge the outputs of the N shards into the output file',
+     required=False, type=int
+        )
+    parser.add_argument('--local_shards',
+     help='Split the file into this many shards and classify them in parallel local processes, '
+          'each reading its own part of the file',
+     required=False, type=int, default=1
+        )
+    parser.add_argument('--precision',
+     help='Precision of the k-mer frequencies and model weights. float32 halves the memory of the '
+          'frequency matrices, changing the scores by less than 1e-5',
+     required=False, type=str, choices=['float64', 'float32'], default='float64'
+        )
+    parser.add_argument('--format',
+     help='Output format: tab separated lines, gzip compressed tab separated lines, or binary columns '
+          '(<outfile>.names, and the float32 scores in <outfile>.probs.npy, which can be memory-mapped)',
+     required=False, type=str, choices=result_writer.FORMATS, default='tsv'
+        )
+    parser.add_argument('--digits',
+     help='Significant digits of the scores in text output (default: as many as needed to read back the same score)',
+     required=False, type=int
+        )
+    parser.add_argument('--columns',
+     help='Comma separated extra output columns: length (of the sequence) and scale (the length scale of the '
+          'model that scored it)',
+     required=False, type=str
+        )
+    parser.add_argument('--save_features','--save-features',
+     help='Also save the k-mer frequencies of the sequences to this directory, as memory-mappable '
+          'matrices of each length scale with the sequence names and lengths',
+     required=False, type=str
+        )
+    parser.add_argument('--load_features','--load-features',
+     help='Classify the sequences whose k-mer frequencies were saved to this directory with '
+          '--save_features, without reading the fasta file or counting k-mers',
+     required=False, type=str
+        )
+    parser.add_argument('--metrics_json','--metrics-json',
+     help='Save the time spent in each stage and the numbers of sequences and bases classified '
+          'at each length scale to this JSON file',
+     required=False, type=str
+        )
 
     return parser.parse_args()
 
@@ -37,46 +120,211 @@ def main(args):
     '''
     infile = args.fasta
     if args.outfile: outfile = args.outfile
-    else: outfile = infile + '.probs.out'
+    elif infile: outfile = infile + OUTFILE_SUFFIXES[args.format]
+    elif args.load_features: outfile = args.load_features.rstrip('/') + OUTFILE_SUFFIXES[args.format]
+    else: sys.exit('A fasta file (-f) or saved features (--load_features) are needed')
     n_procs = args.num_processes
+    if args.save_features and (args.cache or args.window or args.shard or args.merge or args.local_shards > 1):
+        sys.exit('--save_features cannot be used with --cache, --window or sharding')
+    output = {'format': args.format, 'digits': args.digits, 'columns': args.columns.split(',') if args.columns else []}
+    for column in output['columns']:
+        if column not in result_writer.COLUMNS:
+            sys.exit('Unknown column {}, not one of {}'.format(column, ','.join(result_writer.COLUMNS)))
+    if args.window and (args.format != 'tsv' or args.digits is not None or args.columns):
+        sys.exit('--format, --digits and --columns apply to sequence scores, not to --window')
+    if args.window and (args.load_features or args.shard or args.merge or args.local_shards > 1):
+        sys.exit('--window cannot be used with sharding or --load_features')
+    if args.window and args.cache:
+        sys.exit('--cache holds sequence scores and cannot be used with --window')
+    if args.format == 'binary' and (args.shard or args.merge or args.local_shards > 1):
+        sys.exit('Shards cannot be merged in the binary format')
+    if (args.shard or args.local_shards > 1) and infile and utils.is_compressed(infile):
+        sys.exit('Sharding requires an uncompressed fasta file, and {} is compressed'.format(infile))
+
+    if args.load_features:
+        with plasclass.plasclass(n_procs, dtype=args.precision) as c:
+            classify_saved_features(c, args.load_features, outfile, output)
+            if args.metrics_json: save_metrics(c, args.metrics_json)
+    elif args.merge:
+        merge_shards(outfile, args.merge)
+    elif args.shard:
+        i, n_shards = [int(v) for v in args.shard.split('/')]
+        if not 1 <= i <= n_shards:
+            sys.exit('Shard number must be from 1 to {}'.format(n_shards))
+        byte_range = utils.shard_ranges(infile, n_shards)[i-1]
+        classify_shard(infile, shard_file(outfile, i, n_shards), n_procs, args.max_bases, byte_range, args.cache, args.cache_size,
+                       args.metrics_json, args.precision, output)
+        logger.info("Shard scores written in: %s", shard_file(outfile, i, n_shards))
+        return
+    elif args.local_shards > 1:
+        n_shards = args.local_shards
+        shards = []
+        for i, byte_range in enumerate(utils.shard_ranges(infile, n_shards)):
+            shard_metrics = shard_file(args.metrics_json, i+1, n_shards) if args.metrics_json else None
+            shards.append(mp.Process(target=classify_shard, args=(infile, shard_file(outfile, i+1, n_shards),
+                                     max(1, n_procs // n_shards), args.max_bases, byte_range, args.cache, args.cache_size,
+                                     shard_metrics, args.precision, output)))
+            shards[-1].start()
+        for p in shards:
+            p.join()
+        if any(p.exitcode != 0 for p in shards):
+            sys.exit('Classifying a shard failed')
+        merge_shards(outfile, n_shards)
+        if args.metrics_json:
+            merge_shard_metrics(args.metrics_json, n_shards)
+    elif args.window:
+        with plasclass.plasclass(n_procs, dtype=args.precision) as c:
+            classify_windows(c, infile, outfile, args.window, args.step, args.max_bases)
+            if args.metrics_json: save_metrics(c, args.metrics_json)
+    else:
+        with plasclass.plasclass(n_procs, cache_dir=args.cache, cache_size=args.cache_size, dtype=args.precision) as c:
+            classify_records(c, infile, outfile, args.max_bases, features_dir=args.save_features, output=output)
+            if args.metrics_json: save_metrics(c, args.metrics_json)
+    logger.info("Finished classifying")
+    logger.info("Class scores written in: %s", outfile)
+
+
+def shard_file(outfile, i, n_shards):
+    return '{}.shard{}of{}'.format(outfile, i, n_shards)
+
+
+def classify_shard(infile, outfile, n_procs, max_bases, byte_range, cache_dir=None, cache_size=None, metrics_json=None,
+                   precision='float64', output=None):
+    ''' Classify the records in byte_range of infile
+    '''
+    with plasclass.plasclass(n_procs, cache_dir=cache_dir, cache_size=cache_size, dtype=precision) as c:
+        classify_records(c, infile, outfile, max_bases, byte_range, output=output)
+        if metrics_json: save_metrics(c, metrics_json)
 
-    c = plasclass.plasclass(n_procs)
-    seq_names = []
-    seqs = []
-    print("Reading {} in batches of 100k sequences".format(infile))
+
+def merge_shards(outfile, n_shards):
+    ''' Concatenate the shard outputs in order, restoring the order of the input file
+    '''
+    with open(outfile,'wb') as o:
+        for i in range(1, n_shards + 1):
+            with open(shard_file(outfile, i, n_shards),'rb') as f:
+                while True:
+                    block = f.read(1<<22)
+                    if not block: break
+                    o.write(block)
+    for i in range(1, n_shards + 1):
+        os.remove(shard_file(outfile, i, n_shards))
+
+
+def save_metrics(c, metrics_json):
+    ''' Save the stage metrics of the classifier c as JSON
+    '''
+    with open(metrics_json,'w') as f:
+        json.dump(c.metrics.to_dict(), f, indent=1)
+
+
+def merge_shard_metrics(metrics_json, n_shards):
+    ''' Sum the metrics of the shards into a single JSON file
+    '''
+    shard_metrics = []
+    for i in range(1, n_shards + 1):
+        with open(shard_file(metrics_json, i, n_shards)) as f:
+            shard_metrics.append(json.load(f))
+        os.remove(shard_file(metrics_json, i, n_shards))
+    with open(metrics_json,'w') as f:
+        json.dump(metrics.merge_metrics(shard_metrics), f, indent=1)
+
+
+def read_records(infile, byte_range=None, lengths=None):
+    ''' Reader stage: yield the (name, seq) records of infile
+    The sequence lengths are appended to the deque lengths, if given
+    '''
     i = 0
-    n_uppers = 0
-    fp = open(infile)
+    for name, seq, _ in utils.read_fastx(infile, byte_range=byte_range):
+        if lengths is not None: lengths.append(len(seq))
+        yield name, seq
+        i += 1
+        if i % 100000 == 0:
+            logger.info("Read %d sequences", i)
+    logger.info("Read %d sequences", i)
+
+
+def classify_records(c, infile, outfile, max_bases, byte_range=None, features_dir=None, output=None):
+    ''' Classify the records of infile (or of byte_range of it) with the classifier c, writing the scores to outfile
+    Reading, classification and writing run concurrently, with at most max_bases bases in flight
+    With features_dir, the k-mer frequencies are also saved there as a feature store
+    output has the format, digits and columns of the result_writer.ResultWriter
+    '''
+    logger.info("Reading and classifying %s", infile)
+    output = output or {}
+    features = None
+    if features_dir:
+        features = feature_store.FeatureWriter(features_dir, c._ks, c._n_features, c._dtype)
+    # the lengths of the records read and not yet written, which are written in the same order
+    lengths = collections.deque() if output.get('columns') else None
+    with result_writer.ResultWriter(outfile, metrics=c.metrics, **output) as write:
+        for name, p in c.classify_stream(read_records(infile, byte_range, lengths), max_bases, features=features):
+            write.add(name, p, *columns(c, output.get('columns'), lengths.popleft() if lengths is not None else None))
+    if features is not None:
+        features.close()
+        logger.info("Features saved in: %s", features_dir)
+    if c.cache_stats() is not None:
+        logger.info(c.cache_stats())
+
+
+def classify_saved_features(c, features_dir, outfile, output=None):
+    ''' Classify the records whose features were saved in features_dir with the classifier c, writing the scores to outfile
+    '''
+    logger.info("Classifying the features saved in %s", features_dir)
+    store = feature_store.FeatureStore(features_dir)
+    lengths = {scale: iter(store.lengths(scale).tolist()) for scale in store.scales}
+    output = output or {}
+    with result_writer.ResultWriter(outfile, metrics=c.metrics, **output) as write:
+        for (name, p), scale in zip(c.classify_features(store), store.order()):
+            write.add(name, p, *columns(c, output.get('columns'), next(lengths[scale])))
+
+
+def columns(c, names, length):
+    ''' The values of the extra output columns names of a record of the given length
+    '''
+    if not names: return ()
+    values = {'length': length, 'scale': c._get_scale(length)}
+    return tuple([values[name] for name in names])
+
+
+def classify_windows(c, infile, outfile, window, step, max_bases):
+    ''' Score the windows along the records of infile, writing a bedGraph to outfile
+    '''
+    logger.info("Reading and classifying windows of %s", infile)
     with open(outfile,'w') as o:
-        for name, seq, _ in utils.readfq(fp):
-            seq_names.append(name)
-            if not seq.isupper():
-                print("WARNING: sequence of {} converted to uppercase".format(name), file=sys.stderr)
-                n_uppers += 1
-                seq = seq.upper()
-            seqs.append(seq)
-            i += 1
-            if i % 100000 == 0:
-                print("Read {} sequences".format(i))
-                probs = c.classify(seqs)
-                for j,p in enumerate(probs):
-                    o.write(seq_names[j] + '\t' + str(p) + '\n')
-                seq_names = []
-                seqs = []
-
-
-        # last bunch of sequences:
-        print("Read {} sequences".format(i))
-        probs = c.classify(seqs)
-        for j,p in enumerate(probs):
-            o.write(seq_names[j] + '\t' + str(p) + '\n')
-    fp.close()
-
-    if n_uppers > 0:
-        print('WARNING: {} sequences converted to uppercase, which is required for analysis'.format(n_uppers))
-    print("Finished classifying")
-    print("Class scores written in: {}".format(outfile))
+        write = TimedWriter(o, c.metrics)
+        for name, (starts, ends, probs) in c.classify_windows_stream(read_records(infile), window, step, max_bases):
+            write(''.join(['{}\t{}\t{}\t{}\n'.format(name, start, end, p) for start, end, p in zip(starts, ends, probs)]))
+        write.flush()
+
+
+class TimedWriter():
+    ''' Write the output of each record to a file, recording the time spent in the write stage
+    of metrics every 10000 records
+    '''
+    def __init__(self, f, metrics, interval=10000):
+        self._f = f
+        self._metrics = metrics
+        self._interval = interval
+        self._records = 0
+        self._seconds = 0.
+
+    def __call__(self, text):
+        start = time.perf_counter()
+        self._f.write(text)
+        self._seconds += time.perf_counter() - start
+        self._records += 1
+        if self._records == self._interval:
+            self.flush()
+
+    def flush(self):
+        if self._records:
+            self._metrics.record('write', self._seconds, self._records)
+        self._records = 0
+        self._seconds = 0.
+
 
 if __name__=='__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
     args = parse_user_input()
     main(args)
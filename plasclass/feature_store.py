@@ -0,0 +1,155 @@
+###
+# Save and load k-mer frequency matrices, so that records can be scored or trained on again without counting
+###
+#
+# A feature store is a directory holding a frequency matrix for each length scale (or training
+# fragment length), split into chunks of rows:
+#
+#   features.json         the header, written last: the format version, ks, n_features, dtype,
+#                         and for each scale its number of rows and chunk files
+#   <scale>.<i>.npy       the rows of chunk i of the scale, in NumPy .npy format (memory-mappable)
+#   <scale>.names         the record names of the rows of the scale, one per line
+#   <scale>.lengths.npy   the record lengths of the rows, int64
+#   <scale>.labels.npy    the labels of the rows, in stores of training fragments
+#   order.npy             the scale of each record in input order, in stores of classified records
+#
+
+import json
+import os
+import re
+
+import numpy as np
+
+VERSION = 1
+HEADER = 'features.json'
+# the files of a store other than its header, removed when a directory is reused
+STORE_FILES = re.compile(r'^(\d+\.(\d+\.npy|names|lengths\.npy|labels\.npy)|order\.npy)$')
+
+class FeatureWriter():
+    ''' Write a feature store in the directory path
+    The records of classify_stream are added a chunk at a time with add_chunk, and the workers
+    write the chunk files. Whole matrices (of training fragments) are added with add_matrix
+    The store is complete once close() has written its header. The header, then the other
+    files of any store already in the directory, are removed first
+    '''
+    def __init__(self, path, ks, n_features, dtype=np.float64):
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, HEADER)):
+            os.remove(os.path.join(path, HEADER))
+        for name in os.listdir(path):
+            if STORE_FILES.match(name):
+                os.remove(os.path.join(path, name))
+        self._path = path
+        self._ks = list(ks)
+        self._n_features = n_features
+        self._dtype = np.dtype(dtype)
+        self._scales = []
+        self._chunks = {}
+        self._names = {}
+        self._lengths = {}
+        self._labels = {}
+        self._order = []
+
+    def add_chunk(self, names, lengths, scales):
+        ''' Add a chunk of records with the given names, lengths and scales, in input order
+        Returns the directory and index of the chunk, for the worker that computes their
+        frequencies and writes the <scale>.<index>.npy files (see plasclass_utils.classify_chunk)
+        '''
+        i = len(self._order)
+        for s in sorted(set(scales)):
+            rows = [j for j, v in enumerate(scales) if v == s]
+            self._add_scale(s)
+            self._chunks[s].append(['{}.{}.npy'.format(s, i), len(rows)])
+            self._names[s] += [names[j] for j in rows]
+            self._lengths[s] += [lengths[j] for j in rows]
+        self._order.append(np.array(scales, dtype=np.int64))
+        return self._path, i
+
+    def add_matrix(self, scale, matrix, names, lengths, labels=None, block_rows=10000):
+        ''' Add the frequency matrix of a scale, with the names, lengths and labels of its rows
+        The matrix is copied in blocks of rows, so it may be a memory-mapped array larger than memory
+        '''
+        self._add_scale(scale)
+        name = '{}.{}.npy'.format(scale, len(self._chunks[scale]))
+        out = np.lib.format.open_memmap(os.path.join(self._path, name), mode='w+', dtype=matrix.dtype, shape=matrix.shape)
+        for start in range(0, len(matrix), block_rows):
+            out[start:start + block_rows] = matrix[start:start + block_rows]
+        out.flush()
+        del out
+        self._dtype = np.dtype(matrix.dtype)
+        self._chunks[scale].append([name, len(matrix)])
+        self._names[scale] += list(names)
+        self._lengths[scale] += list(lengths)
+        if labels is not None:
+            self._labels[scale] = np.concatenate([self._labels.get(scale, np.zeros(0)), labels])
+
+    def _add_scale(self, scale):
+        if scale not in self._chunks:
+            self._scales.append(scale)
+            self._chunks[scale], self._names[scale], self._lengths[scale] = [], [], []
+
+    def close(self):
+        ''' Write the names, lengths, labels and order of the records, then the header
+        '''
+        scales = sorted(self._scales)
+        for s in scales:
+            with open(os.path.join(self._path, '{}.names'.format(s)), 'w') as f:
+                f.write(''.join([name + '\n' for name in self._names[s]]))
+            np.save(os.path.join(self._path, '{}.lengths.npy'.format(s)), np.array(self._lengths[s], dtype=np.int64))
+            if s in self._labels:
+                np.save(os.path.join(self._path, '{}.labels.npy'.format(s)), self._labels[s])
+        if self._order:
+            np.save(os.path.join(self._path, 'order.npy'), np.concatenate(self._order))
+        header = {'version': VERSION, 'ks': self._ks, 'n_features': self._n_features, 'dtype': self._dtype.str,
+                  'scales': {str(s): {'rows': sum([n for _, n in self._chunks[s]]), 'chunks': self._chunks[s]} for s in scales}}
+        with open(os.path.join(self._path, HEADER), 'w') as f:
+            json.dump(header, f, indent=1)
+
+
+class FeatureStore():
+    ''' A feature store written by FeatureWriter, with the matrices memory-mapped read-only
+    '''
+    def __init__(self, path):
+        header_path = os.path.join(path, HEADER)
+        if not os.path.exists(header_path):
+            raise ValueError('{} is not a complete feature store'.format(path))
+        with open(header_path) as f:
+            header = json.load(f)
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported feature store version {} in {}'.format(header['version'], path))
+        self._path = path
+        self._header = header
+        self.ks = header['ks']
+        self.n_features = header['n_features']
+        self.dtype = np.dtype(header['dtype'])
+        self.scales = sorted([int(s) for s in header['scales']])
+
+    def rows(self, scale):
+        return self._header['scales'][str(scale)]['rows']
+
+    def chunks(self, scale):
+        ''' Yield the chunks of the matrix of the scale, memory-mapped
+        '''
+        for name, _ in self._header['scales'][str(scale)]['chunks']:
+            yield np.load(os.path.join(self._path, name), mmap_mode='r')
+
+    def matrix(self, scale):
+        ''' The matrix of the scale, memory-mapped if it is stored in a single chunk
+        '''
+        chunks = list(self.chunks(scale))
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+    def names(self, scale):
+        with open(os.path.join(self._path, '{}.names'.format(scale))) as f:
+            return f.read().splitlines()
+
+    def lengths(self, scale):
+        return np.load(os.path.join(self._path, '{}.lengths.npy'.format(scale)))
+
+    def labels(self, scale):
+        return np.load(os.path.join(self._path, '{}.labels.npy'.format(scale)))
+
+    def order(self):
+        ''' The scale of each record in input order, for stores of classified records
+        '''
+        return np.load(os.path.join(self._path, 'order.npy'))
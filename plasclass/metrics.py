@@ -0,0 +1,106 @@
+###
+# Stage timers and counters of PlasClass classification
+###
+
+import contextlib
+import threading
+import time
+
+# parse: reading the records, partition: grouping sequences by length scale, count: k-mer counting,
+# score: standardizing and scoring (the scaler is fused into the score kernel), write: writing results
+STAGES = ['parse', 'partition', 'count', 'score', 'write']
+
+
+class Metrics():
+    ''' Timers and counters of the classification stages, and counts of the sequences and bases
+    classified at each length scale
+    Stages run in the worker processes are timed there and summed over the workers, so their
+    times can add up to more than the wall time
+    Each hook is called with every recorded event, a dictionary with the stage, seconds,
+    sequences and bases. Hooks may be called from the reader thread of a stream
+    '''
+    def __init__(self, hooks=None):
+        self._lock = threading.Lock()
+        self._hooks = list(hooks) if hooks is not None else []
+        self.reset()
+
+    def reset(self):
+        ''' Zero the timers and counters
+        '''
+        with self._lock:
+            self._stages = {s: _stage_totals() for s in STAGES}
+            self._scales = {}
+            self._start = time.time()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    @contextlib.contextmanager
+    def stage(self, name, sequences=0, bases=0):
+        ''' Time a stage run in this process
+        '''
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start, sequences, bases)
+
+    def record(self, name, seconds, sequences=0, bases=0):
+        ''' Record a run of a stage that took seconds and processed sequences with bases in total
+        '''
+        with self._lock:
+            totals = self._stages.setdefault(name, _stage_totals())
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+            totals['sequences'] += sequences
+            totals['bases'] += bases
+        if self._hooks:
+            event = {'stage': name, 'seconds': seconds, 'sequences': sequences, 'bases': bases}
+            for hook in self._hooks:
+                hook(event)
+
+    def count_scale(self, scale, sequences, bases):
+        ''' Count sequences with bases in total classified with the model of a length scale
+        '''
+        with self._lock:
+            totals = self._scales.setdefault(scale, {'sequences': 0, 'bases': 0})
+            totals['sequences'] += sequences
+            totals['bases'] += bases
+
+    def to_dict(self):
+        ''' The metrics as a dictionary that can be saved as JSON, with the throughput of each stage
+        '''
+        with self._lock:
+            stages = {s: dict(t, bases_per_sec=_throughput(t)) for s, t in self._stages.items()}
+            scales = {str(s): dict(t) for s, t in sorted(self._scales.items())}
+            return {'elapsed_seconds': time.time() - self._start, 'stages': stages, 'scales': scales}
+
+
+def merge_metrics(metrics_dicts):
+    ''' Sum the metrics dictionaries (from to_dict) of separate runs, such as the shards of a file
+    The elapsed time is that of the longest run
+    '''
+    stages = {}
+    scales = {}
+    for m in metrics_dicts:
+        for s, t in m['stages'].items():
+            totals = stages.setdefault(s, _stage_totals())
+            for key in totals:
+                totals[key] += t[key]
+        for s, t in m['scales'].items():
+            totals = scales.setdefault(s, {'sequences': 0, 'bases': 0})
+            for key in totals:
+                totals[key] += t[key]
+    for t in stages.values():
+        t['bases_per_sec'] = _throughput(t)
+    return {'elapsed_seconds': max([m['elapsed_seconds'] for m in metrics_dicts] + [0.]),
+            'stages': stages, 'scales': dict(sorted(scales.items(), key=lambda s: int(s[0])))}
+
+
+def _stage_totals():
+    return {'seconds': 0., 'calls': 0, 'sequences': 0, 'bases': 0}
+
+
+def _throughput(totals):
+    return totals['bases'] / totals['seconds'] if totals['seconds'] > 0 and totals['bases'] > 0 else None
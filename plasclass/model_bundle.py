@@ -0,0 +1,153 @@
+###
+# Read and write PlasClass model bundles
+###
+#
+# A model bundle holds the multi-scale models in a single file that can be
+# memory-mapped and loaded with NumPy alone. The layout is:
+#
+#   bytes 0-7    magic b'PLASCLSB'
+#   bytes 8-11   format version, little-endian uint32
+#   bytes 12-15  header length H, little-endian uint32
+#   bytes 16-    H bytes of UTF-8 JSON header, zero padded to a multiple of 64 bytes
+#   then         the arrays, little-endian float64, each starting on an 8 byte boundary
+#
+# The JSON header has the fields:
+#   ks          - the k-mer lengths of the feature vectors
+#   scales      - the sequence length scales, one model per scale
+#   n_features  - the length of the feature vectors
+#   models      - for each scale (as a string), the [offset, length] in the file of
+#                 the arrays 'mean', 'scale' and 'coef' (standard scaler and logistic
+#                 regression parameters) and 'intercept'
+#
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'PLASCLSB'
+VERSION = 1
+ARRAYS = ['mean', 'scale', 'coef', 'intercept']
+DEFAULT_BUNDLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'models.pcb')
+
+
+def write_bundle(path, ks, models):
+    ''' Write a model bundle
+        models maps each scale to a dictionary with the arrays 'mean', 'scale', 'coef' and 'intercept'
+    '''
+    scales = sorted(models)
+    arrays = {s: {a: np.ascontiguousarray(np.ravel(models[s][a]), dtype='<f8') for a in ARRAYS} for s in scales}
+    n_features = len(arrays[scales[0]]['coef'])
+    for s in scales:
+        for a in ARRAYS[:3]:
+            if len(arrays[s][a]) != n_features:
+                raise ValueError('Model {} has {} {} values, expected {}'.format(s, len(arrays[s][a]), a, n_features))
+
+    # the header length depends on the offsets, so lay out the arrays relative to the data start first
+    rel_offsets = {}
+    pos = 0
+    for s in scales:
+        rel_offsets[s] = {}
+        for a in ARRAYS:
+            rel_offsets[s][a] = pos
+            pos += arrays[s][a].nbytes
+    header = {'ks': [int(k) for k in ks], 'scales': [int(s) for s in scales], 'n_features': n_features, 'models': {}}
+    data_start = 0
+    while True:
+        header['models'] = {str(s): {a: [data_start + rel_offsets[s][a], len(arrays[s][a])] for a in ARRAYS} for s in scales}
+        header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+        start = _pad(16 + len(header_bytes), 64)
+        if start == data_start: break
+        data_start = start
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<II', VERSION, len(header_bytes)) + header_bytes)
+        f.write(b'\0' * (data_start - 16 - len(header_bytes)))
+        for s in scales:
+            for a in ARRAYS:
+                f.write(arrays[s][a].tobytes())
+
+
+def read_header(path):
+    ''' Read the JSON header of a model bundle
+    '''
+    with open(path, 'rb') as f:
+        prefix = f.read(16)
+        if len(prefix) < 16 or prefix[:8] != MAGIC:
+            raise ValueError('{} is not a PlasClass model bundle'.format(path))
+        version, header_len = struct.unpack('<II', prefix[8:])
+        if version != VERSION:
+            raise ValueError('Unsupported model bundle version {} in {}'.format(version, path))
+        return json.loads(f.read(header_len).decode('utf-8'))
+
+
+def read_bundle(path=DEFAULT_BUNDLE, mmap=True):
+    ''' Read a model bundle
+        Returns the header and a dictionary mapping each scale to its arrays
+        If mmap is True the arrays are read-only views of the memory-mapped file
+    '''
+    header = read_header(path)
+    if mmap:
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        data = np.fromfile(path, dtype=np.uint8)
+    models = {}
+    for s in header['scales']:
+        models[s] = {}
+        for a in ARRAYS:
+            offset, length = header['models'][str(s)][a]
+            models[s][a] = data[offset:offset + 8*length].view('<f8')
+    return header, models
+
+
+def convert_pickles(data_dir, path, ks=[3,4,5,6,7], scales=[1000,10000,100000,500000]):
+    ''' Convert joblib pickled sklearn scalers (s<scale>) and classifiers (m<scale>) to a model bundle
+        Requires the scikit-learn version that wrote the pickles
+    '''
+    from joblib import load
+    models = {}
+    for s in scales:
+        clf = load(os.path.join(data_dir, 'm'+str(s)))
+        scaler = load(os.path.join(data_dir, 's'+str(s)))
+        models[s] = sklearn_params(scaler, clf)
+    write_bundle(path, ks, models)
+
+
+def sklearn_params(scaler, clf):
+    ''' Get the bundle arrays of a fitted StandardScaler and LogisticRegression
+    '''
+    n_features = clf.coef_.shape[1]
+    return {'mean': scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features),
+            'scale': scaler.scale_ if scaler.scale_ is not None else np.ones(n_features),
+            'coef': clf.coef_[0],
+            'intercept': clf.intercept_[:1]}
+
+
+def _pad(n, align):
+    return (n + align - 1) // align * align
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert joblib pickled PlasClass models to a model bundle'
+        )
+    parser.add_argument('-d','--datadir',
+     help='directory with the pickled models m<scale> and scalers s<scale>',
+     required=True, type=str
+     )
+    parser.add_argument('-o','--outfile',
+     help='model bundle to write',
+     required=True, type=str
+     )
+    parser.add_argument('-k','--kmers',
+     help='comma-separated list of k-mer lengths',
+     required=False, type=str, default='3,4,5,6,7'
+     )
+    parser.add_argument('-l','--lengths',
+     help='comma-separated list of sequence length bins',
+     required=False, type=str, default='1000,10000,100000,500000'
+     )
+    args = parser.parse_args()
+    convert_pickles(args.datadir, args.outfile, [int(k) for k in args.kmers.split(',')], [int(s) for s in args.lengths.split(',')])
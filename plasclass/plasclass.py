@@ -3,108 +3,526 @@
 ###
 
 import numpy as np
-import os
-from sklearn.linear_model import LogisticRegression
-from sklearn.preprocessing import StandardScaler
-from joblib import load
 
+import collections
+import collections.abc
+import logging
 import multiprocessing as mp
-from multiprocessing import Manager
+import queue
+import threading
+import time
 
 import plasclass.plasclass_utils as utils
+import plasclass.model_bundle as bundle
+import plasclass.metrics as metrics
+
+logger = logging.getLogger(__name__)
 
 class plasclass():
-    def __init__(self, n_procs = 1, scales = [1000,10000,100000,500000], ks = [3,4,5,6,7]):
+    def __init__(self, n_procs = 1, scales = [1000,10000,100000,500000], ks = [3,4,5,6,7], model = None,
+                 cache_dir = None, cache_size = 10000000, hooks = None, dtype = np.float64,
+                 batch_size = 100000, max_memory = None):
         self._scales = scales
+        self._dtype = np.dtype(dtype)
+        if self._dtype not in (np.float32, np.float64):
+            raise ValueError('Can only classify with float32 or float64 precision, not {}'.format(self._dtype))
+        self.metrics = metrics.Metrics(hooks)
         self._ks = ks
+        self._model = model if model is not None else bundle.DEFAULT_BUNDLE
         self._compute_kmer_inds()
         self._load_classifiers()
         self._n_procs = n_procs
+        self._batch_size = batch_size
+        self._max_memory = max_memory
+        self._pool = None
+        self._cache = None
+        if cache_dir is not None:
+            import plasclass.result_cache as result_cache
+            self._cache = result_cache.ResultCache(cache_dir, result_cache.model_id(self._model, self._ks, self._dtype), cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        ''' Shut down the worker pool
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    def cache_stats(self):
+        ''' Summary of the result cache hits and misses, or None without a cache
+        '''
+        return self._cache.stats() if self._cache is not None else None
 
     def classify(self,seq):
         '''Classify the sequence(s), return the probability of the sequence(s) being a plasmid.
-        Assumes seq is either an individual string or a list of strings
+        Assumes seq is either an individual string (or bytes) or a list of them
         Returns either an individual plasmid probability for seq or a list of
         plasmid probabilities for each sequence in seq
         '''
-        if isinstance(seq, str): # single sequence
-            print("Counting k-mers for sequence of length {}".format(len(seq)))
-            kmer_freqs = [0]
+        if isinstance(seq, (str, bytes)): # single sequence
+            if self._cache is not None:
+                key = self._cache.key(seq)
+                cached = self._cache.get_many([key])
+                if key in cached: return cached[key]
+            logger.debug("Counting k-mers for sequence of length %d", len(seq))
             scale = self._get_scale(len(seq))
-            utils.count_kmers([0, seq, self._ks, self._kmer_inds, self._kmer_count_lens, kmer_freqs])
-            kmer_freqs = np.array(kmer_freqs)
-            standardized_freqs = self._standardize(kmer_freqs, scale)
-            print("Classifying")
-            return self.classifiers[scale]['clf'].predict_proba(standardized_freqs)[0,1]
+            with self.metrics.stage('count', 1, len(seq)):
+                kmer_freqs = utils.kmer_frequencies(seq, self._ks, self._kmer_inds, self._kmer_count_lens, self._dtype)
+            with self.metrics.stage('score', 1, len(seq)):
+                prob = self._score(kmer_freqs, scale)[0]
+            self.metrics.count_scale(scale, 1, len(seq))
+            if self._cache is not None:
+                self._cache.put_many([(key, prob)])
+            return prob
 
         elif isinstance(seq, list): # list of sequences
-            print("{} sequences to classify. Classifying in batches of 100k".format(len(seq)))
-            results = []
-            seq_ind = 0
-            pool = mp.Pool(self._n_procs)
-
-            while seq_ind < len(seq):
-                print("Starting new batch")
-                seq_batch = seq[seq_ind:seq_ind + 100000]
+            if self._cache is not None:
+                return self._classify_cached(seq)
+            return self._classify_list(seq)
+
+        else:
+            raise TypeError('Can only classify strings or lists of strings')
+
+    def classify_stream(self, records, max_bases=100000000, chunk_bases=1000000, features=None):
+        '''Classify a stream of (name, seq) records, yielding (name, probability) in input order.
+        Records are read in a background thread and grouped into chunks of about chunk_bases,
+        which the workers count and score. At most max_bases bases are in flight at once, so
+        memory use does not depend on the number of records.
+        features: a feature_store.FeatureWriter that the workers also write the k-mer frequencies
+        of each chunk to. It is not closed, and cannot be used with a result cache.
+        '''
+        if features is not None and self._cache is not None:
+            raise ValueError('Features cannot be saved when classifying with a result cache')
+        return self._stream(records, utils.classify_chunk, (), max_bases, chunk_bases, self._cache, count_scales=True,
+                            features=features)
+
+    def classify_features(self, store):
+        '''Classify the records of a feature_store.FeatureStore saved by classify_stream, without
+        counting their k-mers. Returns the (name, probability) pairs in the order they were saved.
+        Each record is scored with the model of its length scale, so the store may have been
+        saved with other scales.
+        '''
+        if list(store.ks) != list(self._ks):
+            raise ValueError('Features were counted with ks={}, not {}'.format(store.ks, self._ks))
+        if store.n_features != self._n_features:
+            raise ValueError('Features have {} columns, not {}'.format(store.n_features, self._n_features))
+        scored = {}
+        for scale in store.scales:
+            lengths = store.lengths(scale)
+            probs = np.zeros(len(lengths))
+            start = 0
+            for chunk in store.chunks(scale):
+                end = start + len(chunk)
+                scales = np.array([self._get_scale(l) for l in lengths[start:end]])
+                for s in [int(s) for s in np.unique(scales)]:
+                    rows = scales == s
+                    with self.metrics.stage('score', int(rows.sum()), int(lengths[start:end][rows].sum())):
+                        probs[start:end][rows] = self._score(chunk if rows.all() else chunk[rows], s)
+                    self.metrics.count_scale(s, int(rows.sum()), int(lengths[start:end][rows].sum()))
+                start = end
+            scored[scale] = zip(store.names(scale), probs)
+        return [next(scored[s]) for s in store.order()]
+
+    def _classify_list(self, seq):
+        ''' Classify a list of sequences in batches, partitioned by length scale
+        A batch has at most batch_size sequences, and its sequences and frequency matrix take at
+        most max_memory megabytes. Within each partition the sequences are counted longest first,
+        in chunks balanced by cost, and the longest sequences are split into pieces
+        '''
+        lengths = [len(s) for s in seq]
+        row_bytes = self._n_features * self._dtype.itemsize
+        max_bytes = self._max_memory * 2**20 if self._max_memory is not None else None
+        batches = utils.batch_bounds(lengths, self._batch_size, max_bytes, row_bytes)
+        logger.info("%d sequences to classify in %d batches", len(seq), len(batches))
+        results = []
+        pool = self._get_pool()
+
+        for first, last in batches:
+            logger.debug("Starting new batch")
+            seq_batch = seq[first:last]
+            batch_bases = sum(lengths[first:last])
+            with self.metrics.stage('partition', len(seq_batch), batch_bases):
                 scales = [self._get_scale(len(s)) for s in seq_batch]
                 scale_partitions = {s: [seq_batch[i] for i,v in enumerate(scales) if v == s] for s in self._scales}
 
-                partitioned_classifications = {}
-                for scale in self._scales:
-                    part_seqs = scale_partitions[scale]
-                    if len(part_seqs) <= 0: continue
-                    print("Getting kmer frequencies for partition length {}".format(scale))
-                    shared_list=Manager().list()
-                    for cur in np.arange(len(part_seqs)):
-                        shared_list.append(0)
-                    pool.map(utils.count_kmers, [[ind, s, self._ks, self._kmer_inds, self._kmer_count_lens, shared_list] for ind,s in enumerate(part_seqs)])
-                    kmer_freqs_mat = np.array(shared_list)
-                    standardized_freqs = self._standardize(kmer_freqs_mat, scale)
-                    print("Classifying sequences of length scale {}".format(scale))
-                    partitioned_classifications[scale] = self.classifiers[scale]['clf'].predict_proba(standardized_freqs)[:,1]
-
-                # recollate the results:
-                scale_inds = {s:0 for s in self._scales}
-                for s in scales:
-                    results.append(partitioned_classifications[s][scale_inds[s]])
-                    scale_inds[s] += 1
-
-                seq_ind += 100000
-
-            pool.close()
-            return np.array(results)
+            partitioned_classifications = {}
+            for scale in self._scales:
+                part_seqs = scale_partitions[scale]
+                if len(part_seqs) <= 0: continue
+                part_bases = sum([len(s) for s in part_seqs])
+                logger.debug("Getting kmer frequencies for partition length %d", scale)
+                chunk_bases = utils.default_chunk_bases(part_bases + len(part_seqs) * utils.SEQ_COST_BASES, self._n_procs)
+                with self.metrics.stage('count', len(part_seqs), part_bases):
+                    kmer_freqs_mat = utils.kmer_freqs_matrix(pool, part_seqs, self._n_features, chunk_bases, self._dtype)
+                logger.debug("Classifying sequences of length scale %d", scale)
+                with self.metrics.stage('score', len(part_seqs), part_bases):
+                    partitioned_classifications[scale] = self._score(kmer_freqs_mat, scale)
+                self.metrics.count_scale(scale, len(part_seqs), part_bases)
 
-        else:
-            raise TypeError('Can only classify strings or lists of strings')
+            # recollate the results:
+            scale_inds = {s:0 for s in self._scales}
+            for s in scales:
+                results.append(partitioned_classifications[s][scale_inds[s]])
+                scale_inds[s] += 1
+
+        return np.array(results)
+
+    def _classify_cached(self, seqs):
+        ''' Classify a list of sequences, counting only those missing from the result cache
+        '''
+        keys = [self._cache.key(s) for s in seqs]
+        cached = self._cache.get_many(keys)
+        missing = [i for i,k in enumerate(keys) if k not in cached]
+        logger.info("%d of %d sequences found in the cache", len(seqs) - len(missing), len(seqs))
+        probs = np.array([cached.get(k, 0.) for k in keys])
+        if missing:
+            probs[missing] = self._classify_list([seqs[i] for i in missing])
+            self._cache.put_many([(keys[i], probs[i]) for i in missing])
+        return probs
+
+    def classify_windows(self, seq, window, step=None):
+        '''Classify the windows of length window, every step bases, along the sequence.
+        The k-mers of the sequence are counted once and each window's frequencies are obtained
+        from the cumulative counts. Each window is scored with the model of its length scale.
+        Returns arrays of the window starts, ends and plasmid probabilities
+        '''
+        step = step if step is not None else window
+        with self.metrics.stage('count', 1, len(seq)):
+            return utils.score_windows(seq, window, step, self._ks, self._kmer_inds, self._kmer_count_lens, self._kernels())
+
+    def classify_windows_stream(self, records, window, step=None, max_bases=100000000, chunk_bases=1000000):
+        '''Classify the windows of a stream of (name, seq) records (see classify_windows),
+        yielding (name, (starts, ends, probabilities)) in input order
+        '''
+        step = step if step is not None else window
+        return self._stream(records, utils.classify_windows_chunk, (window, step), max_bases, chunk_bases)
+
+    def _stream(self, records, chunk_func, chunk_args, max_bases, chunk_bases, cache=None, count_scales=False,
+                features=None):
+        ''' Run chunk_func(seqs, *chunk_args) in the workers over chunks of the records,
+        yielding (name, result) in input order with at most max_bases bases in flight
+        chunk_func returns the results and the seconds it spent in each stage
+        With a result cache, only the records missing from the cache are sent to the workers
+        If count_scales, the sequences sent are counted in the metrics of their length scale
+        With a feature writer, each chunk is added to it and chunk_func gets the directory and index of its feature chunk
+        '''
+        pool = self._get_pool()
+        max_bases = max(max_bases, chunk_bases)
+        chunks = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        reader = threading.Thread(target=_read_chunks, args=(records, chunk_bases, chunks, self.metrics, stop))
+        reader.daemon = True
+        reader.start()
+
+        pending = collections.deque()
+        in_flight = 0
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None: break
+                if isinstance(chunk, Exception): raise chunk
+                names, seqs, bases = chunk
+                while pending and in_flight + bases > max_bases:
+                    in_flight -= pending[0][-1]
+                    for name_result in _finish_chunk(pending.popleft(), cache, self.metrics):
+                        yield name_result
+                if features is not None:
+                    feature_chunk = features.add_chunk(names, [len(s) for s in seqs], [self._get_scale(len(s)) for s in seqs])
+                    pending.append(self._submit_chunk(pool, chunk_func, tuple(chunk_args) + (feature_chunk,), names, seqs,
+                                                      bases, cache, count_scales))
+                else:
+                    pending.append(self._submit_chunk(pool, chunk_func, chunk_args, names, seqs, bases, cache, count_scales))
+                in_flight += pending[-1][-1]
+
+            while pending:
+                for name_result in _finish_chunk(pending.popleft(), cache, self.metrics):
+                    yield name_result
+        finally:
+            # if the stream was abandoned, unblock the reader, which stops before putting another chunk
+            stop.set()
+            while True:
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    break
+
+    async def aclassify_stream(self, records, max_bases=100000000, chunk_bases=1000000):
+        '''Classify an async iterable of (name, seq) records, yielding (name, probability) in input order.
+        The asyncio counterpart of classify_stream: chunks of about chunk_bases are counted and
+        scored by the persistent worker pool without blocking the event loop, and the results of
+        each chunk are yielded as soon as it and the chunks before it are done. Records are only
+        read while fewer than max_bases bases are in flight, applying backpressure to the source.
+        With a result cache, the cache lookups and writes run in the default executor of the loop.
+        '''
+        import asyncio
+        pool = self._get_pool()
+        loop = asyncio.get_running_loop()
+        async def off_loop(func, *args):
+            if self._cache is None: return func(*args)
+            return await loop.run_in_executor(None, func, *args) # SQLite calls block
+        max_bases = max(max_bases, chunk_bases)
+        source = _achunks(records, chunk_bases)
+        next_chunk = asyncio.ensure_future(source.__anext__())
+        pending = collections.deque()
+        in_flight = 0
+        try:
+            while next_chunk is not None or pending:
+                waiting = [pending[0][1]] if pending else []
+                if next_chunk is not None: waiting.append(next_chunk)
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                while pending and pending[0][1].done():
+                    chunk, _ = pending.popleft()
+                    in_flight -= chunk[-1]
+                    for name_result in await off_loop(_finish_chunk, chunk, self._cache, self.metrics):
+                        yield name_result
+                if next_chunk is None or not next_chunk.done(): continue
+                try:
+                    names, seqs, bases = next_chunk.result()
+                except StopAsyncIteration:
+                    next_chunk = None
+                    continue
+                while pending and in_flight + bases > max_bases: # wait before reading more records
+                    chunk, done = pending.popleft()
+                    await done
+                    in_flight -= chunk[-1]
+                    for name_result in await off_loop(_finish_chunk, chunk, self._cache, self.metrics):
+                        yield name_result
+                done = loop.create_future()
+                notify = lambda _, done=done: _notify_loop(loop, done)
+                chunk = await off_loop(self._submit_chunk, pool, utils.classify_chunk, (), names, seqs, bases, self._cache, True, notify)
+                if chunk[3] is None: done.set_result(None)
+                pending.append((chunk, done))
+                in_flight += chunk[-1]
+                next_chunk = asyncio.ensure_future(source.__anext__())
+        finally:
+            if next_chunk is not None: next_chunk.cancel()
+            # chunks still in the pool when the stream is abandoned finish there, and their
+            # callbacks find the loop closed or their futures unwatched
+            pending.clear()
+
+    def _submit_chunk(self, pool, chunk_func, chunk_args, names, seqs, bases, cache, count_scales, callback=None):
+        ''' Send the sequences of a chunk of records that are missing from the cache to the workers
+        callback is called (in a thread of the pool) when the chunk is done or failed
+        Returns the pending chunk (names, keys, cached, result, bases) for _finish_chunk, with no
+        result if all the records were cached
+        '''
+        keys, cached = None, None
+        if cache is not None:
+            keys = [cache.key(s) for s in seqs]
+            cached = cache.get_many(keys)
+            seqs = [s for s,k in zip(seqs, keys) if k not in cached]
+            bases = sum([len(s) for s in seqs])
+        if count_scales:
+            for seq in seqs:
+                self.metrics.count_scale(self._get_scale(len(seq)), 1, len(seq))
+        result = None
+        if seqs:
+            result = pool.apply_async(chunk_func, (seqs,) + tuple(chunk_args), callback=callback, error_callback=callback)
+        return (names, keys, cached, result, bases)
 
+    def _kernels(self):
+        ''' The fused (weights, bias) of each scale, loaded the first time they are used
+        '''
+        return self.classifiers.kernels()
+
+    def _get_pool(self):
+        ''' Get the persistent worker pool, starting it on first use
+        The k-mer index tables and model kernels are installed once in each worker
+        '''
+        if self._pool is None:
+            self._pool = mp.Pool(self._n_procs, initializer=utils.init_worker,
+                                 initargs=(self._ks, None, None, self._kernels()))
+        return self._pool
 
     def _load_classifiers(self):
-        ''' Load the multi-scale classifiers and scalers
+        ''' Check the model bundle and set up the multi-scale classifiers and scalers
+        The model of each scale is only loaded the first time a sequence is classified with it
         '''
-        curr_path = os.path.dirname(os.path.abspath(__file__))
-        data_path = os.path.join(curr_path,'data')
-        self.classifiers = {}
+        header = bundle.read_header(self._model)
+        if list(header['ks']) != list(self._ks):
+            raise ValueError('Model bundle {} was trained with ks={}, not {}'.format(self._model, header['ks'], self._ks))
         for i in self._scales:
-            print("Loading classifier " + str(i))
-            self.classifiers[i] = {'clf': load(os.path.join(data_path,'m'+str(i))), 'scaler': load(os.path.join(data_path,'s'+str(i)))}
+            if i not in header['scales']:
+                raise ValueError('Model bundle {} has no model for scale {}'.format(self._model, i))
+        self.classifiers = ScaleModels(self._model, self._scales, self._dtype)
 
 
     def _get_scale(self, length):
         ''' Choose which length scale to use for the sequence
         '''
-        if length <= self._scales[0]: return self._scales[0]
-        for i,l in enumerate(self._scales[:-1]):
-             if length <= float(l + self._scales[i+1])/2.0:
-                return l
-        return self._scales[-1]
+        return utils.get_scale(length, self._scales)
 
     def _standardize(self, freqs, scale):
-        ''' Use sklearn's standard scaler to standardize
+        ''' Standardize with the scaler parameters
         Choose the appropriate scaler based on sequence length
         '''
-        return self.classifiers[scale]['scaler'].transform(freqs)
+        return (freqs - self.classifiers[scale]['mean']) / self.classifiers[scale]['scale']
+
+    def _score(self, freqs, scale):
+        ''' Plasmid probabilities of the rows of freqs using the fused kernel of the scale
+        '''
+        return utils.linear_proba(freqs, self.classifiers[scale]['weights'], self.classifiers[scale]['bias'])
 
     def _compute_kmer_inds(self):
         ''' Get the indeces of each canonical kmer in the kmer count vectors
         '''
-        self._kmer_inds, self._kmer_count_lens = utils.compute_kmer_inds(self._ks)
+        self._kmer_inds, self._kmer_count_lens = utils.kmer_index_tables(self._ks)
+        self._n_features = sum([self._kmer_count_lens[k] for k in self._ks])
+
+
+class ScaleModels(collections.abc.Mapping):
+    ''' The models of the scales of a model bundle, each loaded the first time it is used
+    Each model has the scaler and classifier parameters of the bundle, and the scaler and
+    classifier fused into a single linear kernel (weights, bias), with the weights in dtype
+    Pickles as the bundle path, so each worker process loads only the models it uses
+    '''
+    def __init__(self, path, scales, dtype=np.float64):
+        self._path = path
+        self._scales = list(scales)
+        self._dtype = dtype
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, scale):
+        if scale not in self._models:
+            if scale not in self._scales:
+                raise KeyError(scale)
+            with self._lock:
+                if scale not in self._models:
+                    logger.debug("Loading classifier %d", scale)
+                    params = bundle.read_bundle(self._path)[1][scale]
+                    weights, bias = utils.fuse_linear_model(params['mean'], params['scale'], params['coef'], params['intercept'][0])
+                    self._models[scale] = dict(params, weights=weights.astype(self._dtype), bias=bias)
+        return self._models[scale]
+
+    def __iter__(self):
+        return iter(self._scales)
+
+    def __len__(self):
+        return len(self._scales)
+
+    def __getstate__(self):
+        return (self._path, self._scales, self._dtype)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def loaded(self):
+        ''' The scales whose models have been loaded
+        '''
+        return sorted(self._models)
+
+    def kernels(self):
+        ''' A mapping of each scale to its (weights, bias), loaded the first time it is used
+        '''
+        return _Kernels(self)
+
+
+class _Kernels(collections.abc.Mapping):
+    def __init__(self, models):
+        self._models = models
+
+    def __getitem__(self, scale):
+        model = self._models[scale]
+        return model['weights'], model['bias']
+
+    def __iter__(self):
+        return iter(self._models)
+
+    def __len__(self):
+        return len(self._models)
+
+
+def _finish_chunk(chunk, cache, metrics):
+    ''' Wait for the results of a chunk of _stream, merge them with the cached results
+    and store them in the cache. The stage times of the workers are recorded in metrics
+    Returns the (name, result) pairs
+    '''
+    names, keys, cached, result, bases = chunk
+    results, stage_times = result.get() if result is not None else ([], {})
+    for stage, seconds in stage_times.items():
+        metrics.record(stage, seconds, len(results), bases)
+    if cache is None:
+        return zip(names, results)
+    results = iter(results)
+    merged = []
+    new = []
+    for name, key in zip(names, keys):
+        if key in cached:
+            merged.append((name, cached[key]))
+        else:
+            merged.append((name, next(results)))
+            new.append((key, merged[-1][1]))
+    if new:
+        cache.put_many(new)
+    return merged
+
+
+def _read_chunks(records, chunk_bases, chunks, metrics, stop):
+    ''' Reader stage of classify_stream: group the records into chunks of about chunk_bases
+    Puts (names, seqs, bases) tuples on the chunks queue, then None (or the exception raised)
+    Returns without putting more once the stop event is set, when the stream was abandoned
+    The time spent reading each chunk is recorded in metrics as the parse stage
+    '''
+    try:
+        names, seqs, bases = [], [], 0
+        start = time.perf_counter()
+        for name, seq in records:
+            names.append(name)
+            seqs.append(seq)
+            bases += len(seq)
+            if bases >= chunk_bases:
+                metrics.record('parse', time.perf_counter() - start, len(seqs), bases)
+                if stop.is_set(): return
+                chunks.put((names, seqs, bases))
+                names, seqs, bases = [], [], 0
+                start = time.perf_counter()
+        if names:
+            metrics.record('parse', time.perf_counter() - start, len(seqs), bases)
+            if stop.is_set(): return
+            chunks.put((names, seqs, bases))
+        if not stop.is_set(): chunks.put(None)
+    except Exception as e:
+        if not stop.is_set(): chunks.put(e)
+
+
+async def _achunks(records, chunk_bases):
+    ''' Group the records of an async iterable into chunks of about chunk_bases
+    Yields (names, seqs, bases) tuples
+    '''
+    names, seqs, bases = [], [], 0
+    async for name, seq in records:
+        names.append(name)
+        seqs.append(seq)
+        bases += len(seq)
+        if bases >= chunk_bases:
+            yield names, seqs, bases
+            names, seqs, bases = [], [], 0
+    if names:
+        yield names, seqs, bases
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _notify_loop(loop, future):
+    ''' Pool callback of aclassify_stream: mark the future of a chunk done in its event loop
+    An exception here would kill the result thread of the pool, so a loop that was closed
+    after the stream was abandoned is ignored
+    '''
+    if loop.is_closed(): return
+    try:
+        loop.call_soon_threadsafe(_set_done, future)
+    except RuntimeError: # closed since the check
+        pass
@@ -4,7 +4,17 @@ complements = {'A':'T', 'C':'G', 'G':'C', 'T':'A'}
 nt_bits = {'A':0,'C':1,'G':2,'T':3}
 
 import numpy as np
+import gzip
 import itertools
+import mmap
+import os
+import tempfile
+import time
+
+nt_codes = np.full(256, 4, dtype=np.uint8)
+for c in nt_bits:
+    nt_codes[ord(c)] = nt_bits[c]
+    nt_codes[ord(c.lower())] = nt_bits[c] # soft-masked bases
 
 def readfq(fp): # this is a generator function
     ''' Adapted from https://github.com/lh3/readfq
@@ -40,6 +50,232 @@ def readfq(fp): # this is a generator function
                 break
 
 
+def read_fastx(path, block_size=1<<22, byte_range=None):
+    ''' Fast reader of fasta or fastq files, which may be gzip (or bgzip) compressed
+        Yields (name, seq, qual) with seq and qual as bytes (qual is None for fasta)
+        Plain files are memory-mapped and compressed files are decompressed in blocks of block_size.
+        Fasta record boundaries are found with bulk searches of the buffer.
+        byte_range=(start, end) reads only the records in that part of a plain file
+        Unlike readfq, a file must contain only fasta or only fastq records
+    '''
+    if is_compressed(path):
+        if byte_range is not None:
+            raise ValueError('Cannot read a byte range of compressed file {}'.format(path))
+        blocks = _gzip_blocks(path, block_size)
+    else:
+        blocks = _mmap_blocks(path, byte_range, block_size)
+    return _fastx_records(blocks, block_size)
+
+
+def parse_fastx(data):
+    ''' Parse fasta or fastq records from bytes in memory, which may be gzip compressed
+        Yields (name, seq, qual) like read_fastx
+    '''
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    return _fastx_records(iter([data]))
+
+
+def _fastx_records(blocks, block_size=1<<22):
+    ''' The records of a stream of blocks of a fasta or fastq file
+    Fastq lines are split from slices of at most block_size bytes of each block
+    '''
+    first = b''
+    for block in blocks:
+        stripped = block[:64].lstrip()
+        if stripped:
+            first = stripped[:1]
+            blocks = itertools.chain([block], blocks)
+            break
+    if first == b'>':
+        return _fasta_records(blocks)
+    elif first == b'@':
+        return _fastq_records(_lines(blocks, block_size))
+    return iter([])
+
+
+def _gzip_blocks(path, block_size):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block: break
+            yield block
+
+
+def _mmap_blocks(path, byte_range=None, block_size=1<<22):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if byte_range is None:
+            yield m
+        else:
+            for pos in range(byte_range[0], byte_range[1], block_size):
+                yield m[pos:min(pos + block_size, byte_range[1])]
+    finally:
+        m.close()
+
+
+def is_compressed(path):
+    ''' Check for the gzip magic bytes
+    '''
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def build_fasta_index(path):
+    ''' Index the records of a plain fasta file, like samtools faidx
+        Returns a list of (name, length, offset, linebases, linewidth) where offset is
+        the byte offset of the sequence, and the byte offset of each record's header
+    '''
+    index = []
+    header_offsets = []
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: return index, header_offsets
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = 0 if m[:1] == b'>' else m.find(b'\n>') + 1
+        if start == 0 and m[:1] != b'>': return index, header_offsets
+        while True:
+            end = m.find(b'\n>', start)
+            end = len(m) if end == -1 else end + 1
+            header_end = m.find(b'\n', start, end)
+            if header_end == -1: header_end = end - 1
+            name = m[start+1:header_end].rstrip(b'\r').partition(b' ')[0].decode()
+            offset = header_end + 1
+            seq = m[offset:end]
+            first_line = seq.find(b'\n') + 1 or len(seq)
+            linebases = len(seq[:first_line].rstrip(b'\r\n'))
+            length = len(seq) - seq.count(b'\n') - seq.count(b'\r')
+            index.append((name, length, offset, linebases, first_line))
+            header_offsets.append(start)
+            if end >= len(m): break
+            start = end
+    finally:
+        m.close()
+    return index, header_offsets
+
+
+def fasta_index(path):
+    ''' Get the index of a plain fasta file
+        Reuses path.fai if it is newer than the fasta file, otherwise builds it and
+        tries to save it. Returns the index entries and the header offsets (see build_fasta_index)
+    '''
+    fai = path + '.fai'
+    if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(path):
+        index = []
+        with open(fai) as f:
+            for line in f:
+                splt = line.rstrip('\n').split('\t')
+                index.append((splt[0],) + tuple(int(v) for v in splt[1:5]))
+        if not index: return index, []
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_offsets = [m.rfind(b'\n', 0, offset - 1) + 1 for _, _, offset, _, _ in index]
+        m.close()
+        return index, header_offsets
+    index, header_offsets = build_fasta_index(path)
+    try:
+        with open(fai, 'w') as f:
+            for entry in index:
+                f.write('\t'.join([str(v) for v in entry]) + '\n')
+    except OSError: # read-only location, keep the index in memory
+        pass
+    return index, header_offsets
+
+
+def shard_ranges(path, n_shards):
+    ''' Split a plain fasta file into n_shards byte ranges of consecutive records
+        with about the same total sequence length
+        Returns a list of (start, end) byte offsets
+    '''
+    index, header_offsets = fasta_index(path)
+    file_size = os.path.getsize(path)
+    lengths = np.array([entry[1] for entry in index], dtype=np.float64)
+    # assign each record to the shard containing the middle of its sequence
+    mids = np.cumsum(lengths) - lengths/2.
+    total = max(lengths.sum(), 1.)
+    shards = np.minimum((mids * n_shards / total).astype(np.int64), n_shards - 1)
+    bounds = np.searchsorted(shards, np.arange(n_shards + 1))
+    offsets = header_offsets + [file_size]
+    return [(offsets[bounds[i]], offsets[bounds[i+1]]) for i in range(n_shards)]
+
+
+def _fasta_record(rec):
+    ''' Split a fasta record (starting at its '>') into name and sequence
+    '''
+    header_end = rec.find(b'\n')
+    if header_end == -1: header_end = len(rec)
+    name = rec[1:header_end].rstrip(b'\r').partition(b' ')[0].decode()
+    return name, rec[header_end+1:].translate(None, b'\r\n'), None
+
+
+def _fasta_records(blocks):
+    pending = [] # the parts of a record continuing into the next block
+    first_block = True
+    for block in blocks:
+        start = 0
+        if first_block: # skip anything before the first record
+            first_block = False
+            if block[:1] != b'>':
+                start = block.find(b'\n>') + 1
+                if start == 0: continue
+        elif pending:
+            if pending[-1][-1:] == b'\n' and block[:1] == b'>':
+                end = 0
+            else:
+                end = block.find(b'\n>')
+                if end == -1:
+                    pending.append(block)
+                    continue
+                pending.append(block[:end])
+                end += 1
+            yield _fasta_record(b''.join(pending))
+            pending = []
+            start = end
+        while True:
+            end = block.find(b'\n>', start)
+            if end == -1:
+                if start < len(block):
+                    pending = [block[start:]]
+                break
+            yield _fasta_record(block[start:end])
+            start = end + 1
+    if pending:
+        yield _fasta_record(b''.join(pending))
+
+
+def _lines(blocks, block_size=1<<22):
+    carry = b''
+    for block in blocks:
+        for pos in range(0, len(block), block_size): # a memory-mapped file is a single block
+            lines = (carry + block[pos:pos + block_size]).split(b'\n')
+            carry = lines.pop()
+            for l in lines:
+                yield l.rstrip(b'\r')
+    if carry:
+        yield carry.rstrip(b'\r')
+
+
+def _fastq_records(lines):
+    lines = iter(lines)
+    for l in lines:
+        if l[:1] != b'@': continue
+        name = l[1:].partition(b' ')[0].decode()
+        seqs = []
+        for l in lines:
+            if l[:1] == b'+': break
+            seqs.append(l)
+        seq = b''.join(seqs)
+        quals = []
+        leng = 0
+        for l in lines:
+            quals.append(l)
+            leng += len(l)
+            if leng >= len(seq): break
+        yield name, seq, (b''.join(quals) if leng >= len(seq) else None)
+
+
 def get_rc(seq):
     ''' Return the reverse complement of seq
     '''
@@ -56,10 +292,10 @@ def mer2bits(kmer):
     return bit_mer
 
 
-def count_kmers(args_array):
-    ''' Count the k-mers in the sequence
-        Return a dictionary of counts
-        Assumes ks is sorted
+def count_kmers_reference(args_array):
+    ''' Count the k-mers in the sequence, one character at a time
+        Reference implementation kept for equivalence testing of count_kmers
+        Assumes ks is sorted and consecutive
     '''
     ret_ind, seq, ks, kmer_inds, vec_lens, shared_list = args_array
 
@@ -132,25 +368,567 @@ def count_kmers(args_array):
     shared_list[ret_ind] = kmer_freqs
 
 
-def compute_kmer_inds(ks):
-    ''' Get the indeces of each canonical kmer in the kmer count vectors
+def encode_seq(seq):
+    ''' Encode the sequence as an array of 2-bit nucleotide codes
+        seq may be a string, bytes or a uint8 array of characters
+        A,C,G,T -> 0,1,2,3 (in either case); any other character -> 4
+    '''
+    if isinstance(seq, str):
+        seq = seq.encode('ascii', 'replace')
+    if not isinstance(seq, np.ndarray):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+    return nt_codes[seq]
+
+
+def kmer_ind_arrays(kmer_inds, ks):
+    ''' Convert the kmer_inds dictionaries to lookup arrays indexed by the bit-mer
+        Lookup arrays are returned as they are
+    '''
+    return {k: kmer_inds[k] if isinstance(kmer_inds[k], np.ndarray) else \
+               np.array([kmer_inds[k][b] for b in range(4**k)], dtype=np.int32) for k in ks}
+
+
+# canonical k-mer index tables, built on first use by kmer_index_table
+_kmer_tables = {}
+
+def kmer_index_table(k):
+    ''' The canonical index of each k-mer as a read-only np.int32 array indexed by the bit-mer,
+        and the number of canonical k-mers
+        The canonical k-mers (those not after their reverse complement) are numbered in the order of
+        their bit-mers, and the other k-mers get the index of their reverse complement
+        The tables are computed with bit operations and cached in the module, so worker processes
+        forked after they are built share them
+    '''
+    if k not in _kmer_tables:
+        rc = np.zeros(1, dtype=np.int32)
+        for j in range(k): # the reverse complement of each bit-mer, extended by one base at a time
+            rc = (rc[:, None] | ((3 - np.arange(4, dtype=np.int32)) << 2*j)).reshape(-1)
+        canonical = rc >= np.arange(4**k, dtype=np.int32)
+        inds = np.cumsum(canonical, dtype=np.int32) - 1
+        table = np.where(canonical, inds, inds[rc])
+        table.flags.writeable = False
+        _kmer_tables[k] = (table, int(canonical.sum()))
+    return _kmer_tables[k]
+
+
+def kmer_index_tables(ks):
+    ''' The canonical k-mer index tables (see kmer_index_table) and the numbers of canonical k-mers
+        of the ks, as dictionaries like compute_kmer_inds
+    '''
+    tables = {k: kmer_index_table(k) for k in ks}
+    return {k: tables[k][0] for k in ks}, {k: tables[k][1] for k in ks}
+
+
+def count_kmer_codes(codes, k, ind_array, vec_len):
+    ''' Count the canonical k-mers in an encoded sequence
+        Windows containing an ambiguous base are skipped
+    '''
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(vec_len, dtype=np.int64)
+    bad = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(codes > 3, out=bad[1:])
+    valid = (bad[k:] - bad[:n]) == 0
+    bits = codes & 3
+    bit_mers = bits[:n].astype(np.int64)
+    for j in range(1, k):
+        bit_mers <<= 2
+        bit_mers |= bits[j:n+j]
+    return np.bincount(ind_array[bit_mers[valid]], minlength=vec_len)
+
+
+def valid_run_lengths(codes):
+    ''' For each position, the number of consecutive unambiguous bases starting there
+    '''
+    pos = np.arange(len(codes))
+    next_bad = np.where(codes > 3, pos, len(codes))
+    next_bad = np.minimum.accumulate(next_bad[::-1])[::-1]
+    return next_bad - pos
+
+
+def count_kmer_codes_derived(codes, ks, kmer_inds, vec_lens):
+    ''' Count the canonical k-mers for all ks from a single count of the largest k
+        The raw (non-canonical) table of the largest k is summed over its trailing
+        bases to get the smaller k-mers that start a valid largest k-mer. The k-mers
+        at the sequence end and before ambiguous bases are added directly.
+        Returns a dictionary of counts
+    '''
+    K = ks[-1]
+    n = len(codes) - K + 1
+    run_lens = valid_run_lengths(codes)
+    raw = np.zeros(4**K, dtype=np.int64)
+    if n > 0:
+        bits = codes & 3
+        bit_mers = bits[:n].astype(np.int64)
+        for j in range(1, K):
+            bit_mers <<= 2
+            bit_mers |= bits[j:n+j]
+        raw += np.bincount(bit_mers[run_lens[:n] >= K], minlength=4**K)
+
+    kmer_counts = {}
+    for k in range(K, ks[0]-1, -1):
+        if k < K: # sum the (k+1)-mer table over its last base
+            raw = raw.reshape(4**k, 4).sum(axis=1)
+        if k not in ks: continue
+        raw_k = raw
+        if k < K:
+            k_runs = run_lens[:len(codes)-k+1]
+            extra = np.flatnonzero((k_runs >= k) & (k_runs < K))
+            bit_mers = codes[extra].astype(np.int64)
+            for j in range(1, k):
+                bit_mers <<= 2
+                bit_mers |= codes[extra+j]
+            raw_k = raw + np.bincount(bit_mers, minlength=4**k)
+        # fold to canonical k-mers
+        kmer_counts[k] = np.bincount(kmer_inds[k], weights=raw_k, minlength=vec_lens[k])
+    return kmer_counts
+
+
+def kmer_frequencies(seq, ks, kmer_inds, vec_lens, dtype=np.float64):
+    ''' Compute the normalised canonical k-mer frequency vector of seq, as an array of dtype
+        kmer_inds maps each k to a lookup array from kmer_ind_arrays
+        Assumes ks is sorted
+    '''
+    return normalize_kmer_counts(kmer_counts(encode_seq(seq), ks, kmer_inds, vec_lens), dtype)
+
+
+def kmer_counts(codes, ks, kmer_inds, vec_lens):
+    ''' Count the canonical k-mers of an encoded sequence for all ks
+        Returns a dictionary of counts
     '''
+    if len(codes) >= 4**ks[-1]//4: # the largest k table is amortised over the sequence
+        return count_kmer_codes_derived(codes, ks, kmer_inds, vec_lens)
+    return {k: count_kmer_codes(codes, k, kmer_inds[k], vec_lens[k]) for k in ks}
 
-    kmer_inds = {k: {} for k in ks}
-    kmer_count_lens = {k: 0 for k in ks}
 
-    alphabet = 'ACGT'
+def normalize_kmer_counts(kmer_counts, dtype=np.float64):
+    ''' The frequency vector (of dtype) of a dictionary of k-mer counts, normalised for each k
+    '''
+    ks = sorted(kmer_counts)
+    kmer_freqs = np.zeros(sum([len(kmer_counts[k]) for k in ks]), dtype=dtype)
+    ind = 0
+    for k in ks:
+        counts = kmer_counts[k]
+        counts_sum = counts.sum()
+        if counts_sum != 0:
+            kmer_freqs[ind:ind+len(counts)] = counts/float(counts_sum)
+        ind += len(counts)
+    return kmer_freqs
+
+
+def kmer_index_tracks(codes, ks, kmer_inds):
+    ''' The canonical k-mer index at each start position of an encoded sequence, -1 where the
+        window contains an ambiguous base, for each k of ks
+        The bit-mers of the largest k are built once and shifted down to the smaller ks
+        Yields (k, track)
+    '''
+    K = max(ks)
+    bad = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(codes > 3, out=bad[1:])
+    # pad so that every position starts a K-mer; the padding is shifted out of the shorter k-mers
+    bits = np.concatenate((codes & 3, np.zeros(K - 1, dtype=codes.dtype)))
+    n = len(codes)
+    bit_mers = bits[:n].astype(np.int64)
+    for j in range(1, K):
+        bit_mers <<= 2
+        bit_mers |= bits[j:n+j]
     for k in ks:
-        all_kmers = [''.join(kmer) for kmer in itertools.product(alphabet,repeat=k)]
-        all_kmers.sort()
-        ind = 0
-        for kmer in all_kmers:
-            bit_mer = mer2bits(kmer)
-            rc_bit_mer = mer2bits(get_rc(kmer))
-            if rc_bit_mer in kmer_inds[k]:
-                kmer_inds[k][bit_mer] = kmer_inds[k][rc_bit_mer]
+        n_k = max(len(codes) - k + 1, 0)
+        track = kmer_inds[k][bit_mers[:n_k] >> 2*(K-k)]
+        track[(bad[k:] - bad[:n_k]) != 0] = -1
+        yield k, track
+
+
+def range_kmer_counts(track, vec_len, starts, ends):
+    ''' Count the k-mers starting in each range [starts[i], ends[i]) of the positions of a track
+        Counts are differences of the cumulative counts at the range boundaries
+        Returns a (len(starts), vec_len) array
+    '''
+    counts = np.zeros((len(starts), vec_len), dtype=np.int64)
+    for inds, range_counts in sweep_kmer_counts(track, vec_len, starts, ends):
+        counts[inds] = range_counts
+    return counts
+
+
+def sweep_kmer_counts(track, vec_len, starts, ends, block_size=256):
+    ''' Count the k-mers starting in each range [starts[i], ends[i]) of the positions of a track,
+        sweeping once along the track
+        The cumulative counts are computed at block_size range boundaries at a time. Only the
+        cumulative counts at the starts of the ranges still open are kept, so memory does not
+        depend on the number of ranges
+        Yields (range indices, counts) as the ranges are closed
+    '''
+    if len(starts) == 0: return
+    ends = np.maximum(ends, starts)
+    checkpoints, inverse = np.unique(np.concatenate((starts, ends)), return_inverse=True)
+    start_cps, end_cps = inverse[:len(starts)], inverse[len(starts):]
+    by_start = np.argsort(start_cps, kind='stable')
+    by_end = np.argsort(end_cps, kind='stable')
+    open_counts = {}
+    carry = np.zeros(vec_len, dtype=np.int64)
+    base = checkpoints[0]
+    for b in range(0, len(checkpoints), block_size):
+        block = checkpoints[b:b+block_size]
+        # positions [base, block[-1]) fall in the segments between consecutive checkpoints
+        bounds = np.concatenate(([base], block))
+        block_track = track[base:min(block[-1], len(track))]
+        segments = np.repeat(np.arange(len(block)), np.diff(bounds))[:len(block_track)]
+        valid = block_track >= 0
+        segment_counts = np.bincount(segments[valid] * vec_len + block_track[valid], minlength=len(block) * vec_len)
+        segment_counts = segment_counts.reshape(len(block), vec_len)
+        prefix = np.empty((len(block) + 1, vec_len), dtype=np.int64)
+        prefix[0] = carry
+        for j in range(len(block)): # row by row is much faster than cumsum along the first axis
+            np.add(prefix[j], segment_counts[j], out=prefix[j+1])
+
+        lo, hi = np.searchsorted(start_cps[by_start], [b, b + len(block)])
+        opening = by_start[lo:hi]
+        for i, row in zip(opening, prefix[start_cps[opening] - b + 1]):
+            open_counts[i] = row
+        lo, hi = np.searchsorted(end_cps[by_end], [b, b + len(block)])
+        closing = by_end[lo:hi]
+        if len(closing) > 0:
+            yield closing, prefix[end_cps[closing] - b + 1] - np.array([open_counts.pop(i) for i in closing])
+        carry = prefix[-1]
+        base = block[-1]
+
+
+def window_bounds(length, window, step):
+    ''' The windows [start, end) of a sequence, every step bases
+        The last window is truncated at the end of the sequence
+    '''
+    starts = np.arange(0, max(length, 1), step)
+    ends = np.minimum(starts + window, length)
+    last = np.argmax(ends >= length)
+    return starts[:last+1], ends[:last+1]
+
+
+def window_kmer_freqs(seq, starts, ends, ks, kmer_inds, vec_lens, batch_size=256, dtype=np.float64):
+    ''' Compute the normalised k-mer frequency vectors of the windows [starts[i], ends[i]) of seq
+        The sequence is counted once; windows are processed in batches of batch_size to bound memory
+    '''
+    codes = encode_seq(seq)
+    kmer_freqs = np.zeros((len(starts), sum([vec_lens[k] for k in ks])), dtype=dtype)
+    ind = 0
+    for k, track in kmer_index_tracks(codes, ks, kmer_inds):
+        for b in range(0, len(starts), batch_size):
+            counts = range_kmer_counts(track, vec_lens[k], starts[b:b+batch_size], ends[b:b+batch_size] - k + 1)
+            counts_sum = counts.sum(axis=1, keepdims=True).astype(np.float64)
+            counts_sum[counts_sum == 0] = 1.
+            kmer_freqs[b:b+batch_size, ind:ind+vec_lens[k]] = counts / counts_sum
+        ind += vec_lens[k]
+    return kmer_freqs
+
+
+def score_windows(seq, window, step, ks, kmer_inds, vec_lens, kernels):
+    ''' Plasmid probabilities of the windows of seq, each scored with the model of its length scale
+        kernels maps each scale, in increasing order, to its fused (weights, bias)
+        The frequencies are computed in the dtype of the weights
+        Returns the window starts, ends and probabilities
+    '''
+    starts, ends = window_bounds(len(seq), window, step)
+    scales = list(kernels)
+    window_scales = np.array([get_scale(l, scales) for l in ends - starts])
+    kmer_freqs = window_kmer_freqs(seq, starts, ends, ks, kmer_inds, vec_lens, dtype=kernels[window_scales[0]][0].dtype)
+    probs = np.zeros(len(starts))
+    for scale in np.unique(window_scales):
+        rows = window_scales == scale
+        probs[rows] = linear_proba(kmer_freqs[rows], *kernels[scale])
+    return starts, ends, probs
+
+
+def count_kmers(args_array):
+    ''' Count the k-mers in the sequence
+        Store the normalised frequency vector in shared_list[ret_ind]
+        kmer_inds may hold either lookup arrays or the dictionaries from compute_kmer_inds
+    '''
+    ret_ind, seq, ks, kmer_inds, vec_lens, shared_list = args_array
+    if isinstance(kmer_inds[ks[0]], dict):
+        kmer_inds = kmer_ind_arrays(kmer_inds, ks)
+    shared_list[ret_ind] = kmer_frequencies(seq, ks, kmer_inds, vec_lens)
+
+
+def create_shared_array(shape, dtype=np.float64):
+    ''' Create an array backed by a memory-mapped file that worker processes can open by path
+        The file is placed in shared memory (/dev/shm) where available
+        Returns the descriptor (path, dtype, shape) and the array
+    '''
+    shm_dir = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+    fd, path = tempfile.mkstemp(prefix='plasclass_', dir=shm_dir)
+    os.close(fd)
+    dtype = np.dtype(dtype).str
+    if np.prod(shape) == 0: # cannot map an empty file
+        return (path, dtype, shape), np.zeros(shape, dtype=dtype)
+    return (path, dtype, shape), np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+
+def open_shared_array(desc):
+    ''' Open an array created by create_shared_array from its descriptor
+    '''
+    path, dtype, shape = desc
+    return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+
+def remove_shared_array(desc):
+    ''' Remove the file backing a shared array
+        Arrays already open in this process stay valid until they are released
+    '''
+    try:
+        os.remove(desc[0])
+    except OSError: # still mapped on platforms that do not allow removing open files
+        pass
+
+
+# per-process state of the pool workers, installed once by init_worker
+_worker = {}
+
+def init_worker(ks, kmer_inds=None, vec_lens=None, kernels=None):
+    ''' Pool initializer: install the k-mer index tables and the model kernels in the worker
+        Without kmer_inds the tables of kmer_index_tables are used, so they are not pickled
+        kernels maps each scale, in increasing order, to its fused (weights, bias)
+    '''
+    if kmer_inds is None:
+        kmer_inds, vec_lens = kmer_index_tables(ks)
+    _worker['ks'] = ks
+    _worker['kmer_inds'] = kmer_inds
+    _worker['vec_lens'] = vec_lens
+    _worker['kernels'] = kernels
+    _worker['scales'] = list(kernels) if kernels is not None else None
+
+
+def classify_chunk(seqs, feature_chunk=None):
+    ''' Plasmid probabilities of a chunk of sequences, in a worker set up by init_worker
+        Each sequence is scored with the model of its length scale, with frequencies computed
+        in the dtype of its weights
+        With the (directory, index) of a feature_chunk (see feature_store.FeatureWriter.add_chunk),
+        the frequencies of the sequences of each scale are also written to <directory>/<scale>.<index>.npy
+        Returns the probabilities and the seconds spent in the count and score stages
+    '''
+    probs = np.zeros(len(seqs))
+    count_time = 0.
+    score_time = 0.
+    scales = [get_scale(len(seq), _worker['scales']) for seq in seqs]
+    features, rows = {}, {}
+    if feature_chunk is not None:
+        directory, index = feature_chunk
+        n_features = sum([_worker['vec_lens'][k] for k in _worker['ks']])
+        for scale in set(scales):
+            dtype = _worker['kernels'][scale][0].dtype
+            path = os.path.join(directory, '{}.{}.npy'.format(scale, index))
+            features[scale] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(scales.count(scale), n_features))
+            rows[scale] = 0
+    for i, seq in enumerate(seqs):
+        weights, bias = _worker['kernels'][scales[i]]
+        start = time.perf_counter()
+        kmer_freqs = kmer_frequencies(seq, _worker['ks'], _worker['kmer_inds'], _worker['vec_lens'], weights.dtype)
+        if features:
+            features[scales[i]][rows[scales[i]]] = kmer_freqs
+            rows[scales[i]] += 1
+        counted = time.perf_counter()
+        probs[i] = linear_proba(kmer_freqs, weights, bias)[0]
+        count_time += counted - start
+        score_time += time.perf_counter() - counted
+    for matrix in features.values():
+        matrix.flush()
+    return probs, {'count': count_time, 'score': score_time}
+
+
+def classify_windows_chunk(seqs, window, step):
+    ''' Window scores (see score_windows) of a chunk of sequences, in a worker set up by init_worker
+        Returns the window scores and the seconds spent counting and scoring them, as the count stage
+    '''
+    start = time.perf_counter()
+    windows = [score_windows(seq, window, step, _worker['ks'], _worker['kmer_inds'], _worker['vec_lens'], _worker['kernels']) \
+               for seq in seqs]
+    return windows, {'count': time.perf_counter() - start}
+
+
+def count_kmers_chunk(args_array):
+    ''' Count the k-mers of a chunk of sequences, in a worker set up by init_worker
+        Sequence i is read from the shared sequence buffer between starts[i] and ends[i], and
+        its normalised frequency vector is written into row rows[i] of the shared matrix, in its dtype
+    '''
+    rows, starts, ends, seq_desc, mat_desc = args_array
+    seq_buf = open_shared_array(seq_desc)
+    mat = open_shared_array(mat_desc)
+    for row, start, end in zip(rows, starts, ends):
+        mat[row] = kmer_frequencies(seq_buf[start:end], _worker['ks'], _worker['kmer_inds'], _worker['vec_lens'], mat.dtype)
+    del seq_buf, mat
+
+
+def count_kmers_piece(args_array):
+    ''' Count the k-mers starting in [start, end) of a sequence ending at seq_end in the shared
+        sequence buffer, in a worker set up by init_worker
+        The counts of the pieces of a sequence add up to the counts of the whole sequence
+        Returns a dictionary of counts
+    '''
+    start, end, seq_end, seq_desc = args_array
+    ks, kmer_inds, vec_lens = _worker['ks'], _worker['kmer_inds'], _worker['vec_lens']
+    seq_buf = open_shared_array(seq_desc)
+    codes = encode_seq(seq_buf[start:min(end + ks[-1] - 1, seq_end)])
+    del seq_buf
+    counts = kmer_counts(codes, ks, kmer_inds, vec_lens)
+    tail = codes[end-start:] # the smaller k-mers starting after the piece
+    for k in ks[:-1]:
+        counts[k] = counts[k] - count_kmer_codes(tail, k, kmer_inds[k], vec_lens[k])
+    return counts
+
+
+def fragment_freqs_chunk(args_array):
+    ''' Compute the k-mer frequencies of fragments of a stretch of sequence, in a worker set up by init_worker
+        Each target (mat_desc, rows, starts, ends) holds fragments [starts[i], ends[i]) of seq whose
+        normalised frequency vectors are written to row rows[i] of the shared matrix
+        The stretch is counted in a single sweep per k (see sweep_kmer_counts)
+    '''
+    seq, targets = args_array
+    codes = encode_seq(seq)
+    mats = [open_shared_array(target[0]) for target in targets]
+    frag_targets = np.concatenate([np.full(len(target[1]), t) for t, target in enumerate(targets)])
+    rows = np.concatenate([target[1] for target in targets])
+    starts = np.concatenate([target[2] for target in targets])
+    ends = np.concatenate([target[3] for target in targets])
+    ks, kmer_inds, vec_lens = _worker['ks'], _worker['kmer_inds'], _worker['vec_lens']
+    ind = 0
+    for k, track in kmer_index_tracks(codes, ks, kmer_inds):
+        for frags, counts in sweep_kmer_counts(track, vec_lens[k], starts, ends - k + 1):
+            counts_sum = counts.sum(axis=1, keepdims=True).astype(np.float64)
+            counts_sum[counts_sum == 0] = 1.
+            freqs = counts / counts_sum
+            for t, mat in enumerate(mats):
+                sel = frag_targets[frags] == t
+                if sel.any():
+                    mat[rows[frags[sel]], ind:ind+vec_lens[k]] = freqs[sel]
+        ind += vec_lens[k]
+    del mats
+
+
+def default_chunk_bases(total_bases, n_procs, min_bases=100000):
+    ''' Chunk size giving each worker several chunks to balance the load
+    '''
+    return max(min_bases, total_bases // (4 * n_procs))
+
+
+# the fixed cost of counting the k-mers of a sequence, in bases
+SEQ_COST_BASES = 5000
+
+def schedule_chunks(lengths, chunk_bases):
+    ''' Plan the counting of sequences of the given lengths as tasks of about chunk_bases of cost,
+        the cost of a sequence being its length plus SEQ_COST_BASES
+        The longest sequences are scheduled first, so that no long task is left for the end.
+        Sequences longer than twice chunk_bases are split into pieces of about chunk_bases
+        Returns a list of tasks, either ('rows', rows) for a chunk of whole sequences or
+        ('piece', row, start, end) for a piece of a sequence
+    '''
+    tasks = []
+    rows, cost = [], 0
+    for i in np.argsort(-np.asarray(lengths, dtype=np.int64), kind='stable'):
+        length = lengths[i]
+        if length > 2 * chunk_bases:
+            bounds = np.linspace(0, length, int(round(length / chunk_bases)) + 1).astype(np.int64)
+            tasks += [('piece', i, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+            continue
+        rows.append(i)
+        cost += length + SEQ_COST_BASES
+        if cost >= chunk_bases:
+            tasks.append(('rows', np.array(rows)))
+            rows, cost = [], 0
+    if rows:
+        tasks.append(('rows', np.array(rows)))
+    return tasks
+
+
+def batch_bounds(lengths, max_seqs, max_bytes=None, row_bytes=0):
+    ''' Split consecutive sequences into batches of at most max_seqs sequences, whose bases plus
+        row_bytes for each sequence add up to at most max_bytes (or which hold a single sequence)
+        Returns a list of (first, last) index ranges
+    '''
+    bounds = []
+    first = 0
+    size = 0
+    for i, l in enumerate(lengths):
+        if i > first and (i - first >= max_seqs or (max_bytes is not None and size + l + row_bytes > max_bytes)):
+            bounds.append((first, i))
+            first = i
+            size = 0
+        size += l + row_bytes
+    if first < len(lengths):
+        bounds.append((first, len(lengths)))
+    return bounds
+
+
+def kmer_freqs_matrix(pool, seqs, n_features, chunk_bases, dtype=np.float64):
+    ''' Compute the k-mer frequency matrix (of dtype) of the sequences using a pool set up by init_worker
+        The sequences are passed to the workers in a shared buffer, in tasks of about chunk_bases
+        planned by schedule_chunks, and the workers write their rows directly into a shared matrix,
+        which is returned. The counts of the pieces of long sequences are merged here
+    '''
+    seqs = [s.encode('ascii', 'replace') if isinstance(s, str) else s for s in seqs]
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in seqs], out=offsets[1:])
+    seq_desc, seq_buf = create_shared_array((max(offsets[-1], 1),), np.uint8)
+    for i, s in enumerate(seqs):
+        seq_buf[offsets[i]:offsets[i+1]] = np.frombuffer(s, dtype=np.uint8)
+    seq_buf.flush()
+    del seq_buf
+    mat_desc, mat = create_shared_array((len(seqs), n_features), dtype)
+    try:
+        tasks = schedule_chunks(np.diff(offsets), chunk_bases)
+        results = []
+        for task in tasks: # submitted in order, so the longest sequences are counted first
+            if task[0] == 'rows':
+                rows = task[1]
+                results.append(pool.apply_async(count_kmers_chunk, ([rows, offsets[rows], offsets[rows+1], seq_desc, mat_desc],)))
             else:
-                kmer_inds[k][bit_mer] = ind
-                kmer_count_lens[k] += 1
-                ind += 1
-    return kmer_inds, kmer_count_lens
+                _, row, start, end = task
+                results.append(pool.apply_async(count_kmers_piece, ([offsets[row] + start, offsets[row] + end, offsets[row+1], seq_desc],)))
+        pieces = {}
+        for task, result in zip(tasks, results):
+            counts = result.get()
+            if task[0] == 'piece':
+                row = task[1]
+                if row not in pieces:
+                    pieces[row] = counts
+                else:
+                    pieces[row] = {k: pieces[row][k] + counts[k] for k in counts}
+        for row, counts in pieces.items():
+            mat[row] = normalize_kmer_counts(counts, mat.dtype)
+    finally:
+        remove_shared_array(seq_desc)
+        remove_shared_array(mat_desc)
+    return mat
+
+
+def get_scale(length, scales):
+    ''' Choose which length scale to use for the sequence
+    '''
+    if length <= scales[0]: return scales[0]
+    for i,l in enumerate(scales[:-1]):
+        if length <= float(l + scales[i+1])/2.0:
+            return l
+    return scales[-1]
+
+
+def fuse_linear_model(mean, scale, coef, intercept):
+    ''' Fold a standard scaler into the logistic regression coefficients
+        Returns the weights and bias so that (x - mean)/scale . coef + intercept == x . weights + bias
+    '''
+    weights = np.asarray(coef, dtype=np.float64) / scale
+    bias = float(intercept - np.sum(mean * weights))
+    return weights, bias
+
+
+def linear_proba(freqs, weights, bias):
+    ''' Logistic probabilities of the rows of freqs under the fused linear model
+        The dot product is in the dtype of freqs and weights, the logistic function in float64
+    '''
+    z = np.atleast_2d(freqs).dot(weights).astype(np.float64) + bias
+    with np.errstate(over='ignore'):
+        return 1. / (1. + np.exp(-z))
+
+
+def compute_kmer_inds(ks):
+    ''' Get the indeces of each canonical kmer in the kmer count vectors
+        Returns dictionaries mapping each bit-mer to its index, built from the tables of kmer_index_tables
+    '''
+    kmer_inds, kmer_count_lens = kmer_index_tables(ks)
+    return {k: dict(enumerate(kmer_inds[k].tolist())) for k in ks}, kmer_count_lens
@@ -0,0 +1,94 @@
+###
+# Persistent cache of classification results, keyed on the sequence content
+###
+
+import numpy as np
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def model_id(model_path, ks, dtype=np.float64):
+    ''' Identify the model bundle, k-mer lengths and precision that produced cached results
+    '''
+    h = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        while True:
+            block = f.read(1<<20)
+            if not block: break
+            h.update(block)
+    h.update(repr(list(ks)).encode())
+    if np.dtype(dtype) != np.float64: # float64 results keep the ids of earlier versions
+        h.update(np.dtype(dtype).str.encode())
+    return h.digest()
+
+
+class ResultCache():
+    ''' An on-disk cache of plasmid probabilities in cache_dir
+    Entries are keyed on a hash of the sequence together with the model id, and at most
+    max_entries are kept, evicting the least recently used
+    '''
+    def __init__(self, cache_dir, model, max_entries=10000000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._model = model
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, 'results.sqlite'), timeout=60, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, prob REAL, used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self._db.commit()
+        self._n_entries = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, seq):
+        ''' The cache key of a sequence (string or bytes)
+        '''
+        if isinstance(seq, str):
+            seq = seq.encode('ascii', 'replace')
+        return hashlib.blake2b(seq, digest_size=20, key=self._model[:64]).digest()
+
+    def get_many(self, keys):
+        ''' Look up the keys, returning a dictionary of the cached probabilities
+        '''
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500): # sqlite limits the number of query parameters
+                batch = keys[i:i+500]
+                rows = self._db.execute('SELECT key, prob FROM results WHERE key IN ({})'.format(','.join('?'*len(batch))), batch)
+                found.update((bytes(k), p) for k, p in rows)
+            if found:
+                now = time.time()
+                self._db.executemany('UPDATE results SET used = ? WHERE key = ?', [(now, k) for k in found])
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        ''' Store (key, probability) pairs, evicting the least recently used entries beyond the size cap
+        '''
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', [(k, float(p), now) for k, p in items])
+            self._n_entries += len(items)
+            if self._n_entries > self._max_entries: # replaced entries were also counted, so recount
+                self._n_entries = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                if self._n_entries > self._max_entries:
+                    self._db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)',
+                                     (self._n_entries - self._max_entries,))
+                    self._n_entries = self._max_entries
+            self._db.commit()
+
+    def stats(self):
+        ''' Summary of the cache hits and misses
+        '''
+        total = self.hits + self.misses
+        return 'Cache: {} hits, {} misses ({:.1f}% hit rate)'.format(self.hits, self.misses, 100. * self.hits / total if total else 0.)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
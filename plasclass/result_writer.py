@@ -0,0 +1,136 @@
+###
+# Write classification results in blocks, as text or as memory-mappable binary columns
+###
+#
+# Formats:
+#
+#   tsv      'name<TAB>score' lines, with optional length and scale columns after the score
+#   tsv.gz   the same, gzip compressed. Concatenated files (such as merged shards) are valid gzip
+#   binary   columns with the path as prefix: <prefix>.names (one name per line), <prefix>.probs.npy
+#            (float32 scores) and optionally <prefix>.lengths.npy and <prefix>.scales.npy (int64),
+#            in NumPy .npy format. read_binary maps them without parsing text
+#
+# Scores are formatted as str(score), the shortest string that reads back as the same float64,
+# unless a number of significant digits is given
+#
+
+import gzip
+import itertools
+import struct
+import time
+
+import numpy as np
+
+FORMATS = ['tsv', 'tsv.gz', 'binary']
+COLUMNS = ['length', 'scale']
+
+
+class ResultWriter():
+    ''' Write (name, score) results to path in one of FORMATS, a block of records at a time
+    columns are the extra COLUMNS to write, whose values are passed to add in the same order
+    Each block of block_records is formatted with a single string formatting operation, written
+    and flushed. The time spent is recorded in the write stage of metrics, if given
+    '''
+    def __init__(self, path, format='tsv', digits=None, columns=(), metrics=None, block_records=10000):
+        if format not in FORMATS:
+            raise ValueError('Unknown result format {}, not one of {}'.format(format, FORMATS))
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError('Unknown result column {}, not one of {}'.format(column, COLUMNS))
+        self._format = format
+        self._columns = list(columns)
+        self._metrics = metrics
+        self._block_records = block_records
+        self._rows = []
+        self._row_format = '%s\t' + ('%s' if digits is None else '%.{}g'.format(digits)) + '\t%d' * len(self._columns) + '\n'
+        if format == 'binary':
+            self._f = open(path + '.names', 'w')
+            self._arrays = {'probs': _NpyWriter(path + '.probs.npy', np.float32)}
+            for column in self._columns:
+                self._arrays[column] = _NpyWriter('{}.{}s.npy'.format(path, column), np.int64)
+        elif format == 'tsv.gz':
+            self._f = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            self._f = open(path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, name, prob, *values):
+        ''' Add the result of a record, followed by the values of the extra columns
+        '''
+        self._rows.append((name, prob) + values)
+        if len(self._rows) >= self._block_records:
+            self.flush()
+
+    def flush(self):
+        ''' Write the results added since the last flush
+        '''
+        if not self._rows: return
+        start = time.perf_counter()
+        n_records = len(self._rows)
+        if self._format == 'binary':
+            self._f.write('\n'.join([row[0] for row in self._rows]) + '\n')
+            self._arrays['probs'].write([row[1] for row in self._rows])
+            for i, column in enumerate(self._columns):
+                self._arrays[column].write([row[2 + i] for row in self._rows])
+        else:
+            self._f.write(((self._row_format * n_records) % tuple(itertools.chain.from_iterable(self._rows))).encode())
+        self._f.flush()
+        self._rows = []
+        if self._metrics is not None:
+            self._metrics.record('write', time.perf_counter() - start, n_records)
+
+    def close(self):
+        self.flush()
+        self._f.close()
+        if self._format == 'binary':
+            for array in self._arrays.values():
+                array.close()
+
+
+class _NpyWriter():
+    ''' Append to a one dimensional .npy file whose length is only known when it is closed
+    The header is written with room for any length, and rewritten on closing
+    '''
+    HEADER_BYTES = 128
+
+    def __init__(self, path, dtype):
+        self._dtype = np.dtype(dtype)
+        self._f = open(path, 'wb')
+        self._length = 0
+        self._write_header()
+
+    def write(self, values):
+        values = np.asarray(values, dtype=self._dtype)
+        self._f.write(values.tobytes())
+        self._length += len(values)
+
+    def close(self):
+        self._f.seek(0)
+        self._write_header()
+        self._f.close()
+
+    def _write_header(self):
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(self._dtype.str, self._length)
+        header = header.ljust(self.HEADER_BYTES - 10 - 1) + '\n' # magic, version and header length take 10 bytes
+        self._f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+def read_binary(path, mmap_mode='r'):
+    ''' Read results written in the binary format with the prefix path
+    Returns the names, the memory-mapped scores and a dictionary of the extra columns written
+    '''
+    with open(path + '.names') as f:
+        names = f.read().splitlines()
+    probs = np.load(path + '.probs.npy', mmap_mode=mmap_mode)
+    columns = {}
+    for column in COLUMNS:
+        try:
+            columns[column] = np.load('{}.{}s.npy'.format(path, column), mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            pass
+    return names, probs, columns
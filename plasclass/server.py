@@ -0,0 +1,347 @@
+###
+# A long-lived PlasClass classification service over a Unix socket or localhost HTTP
+###
+#
+# The models and worker pool are loaded once and requests are served over HTTP:
+#
+#   POST /classify  the body is fasta or fastq records (optionally gzip compressed), or with
+#                   Content-Type application/json an object {"path": <file>} naming a file that
+#                   the server reads itself. The response is tab separated 'name<TAB>score' lines
+#                   in input order, as written by classify_fasta.py. The query parameter columns
+#                   (for example ?columns=length,scale) adds the length and length scale of each
+#                   record after its score, and window (with an optional step) returns the scores
+#                   of windows along each record as bedGraph lines instead
+#   GET /health     'ok'
+#   GET /metrics    the classifier metrics (see plasclass.metrics) as JSON
+#
+# Concurrent requests are micro-batched: the requests arriving within max_wait seconds of the
+# first (up to batch_bases bases in total) are classified together, sharing counting and
+# scoring chunks, and each request gets back its own results.
+#
+
+import http.client
+import http.server
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from plasclass import plasclass
+from plasclass import plasclass_utils as utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+COLUMNS = ['length', 'scale']
+
+
+class Batcher():
+    ''' Classify the records of concurrent requests together in micro-batches
+    A single thread owns the classifier. It waits up to max_wait seconds after the first request
+    of a batch for more requests, up to batch_bases bases, then classifies them as one stream
+    '''
+    def __init__(self, classifier, max_wait=0.005, batch_bases=10000000):
+        self._classifier = classifier
+        self._max_wait = max_wait
+        self._batch_bases = batch_bases
+        self._requests = queue.Queue()
+        self.n_batches = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def classify(self, records, window=None, step=None):
+        ''' Classify a list of (name, seq) records, returning the (name, score) pairs in order,
+        or with a window length the (name, (starts, ends, scores)) of the windows of each record
+        Blocks until the batch holding the records has been classified
+        '''
+        request = _Request(records, window, step)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            request = self._requests.get()
+            if request is None: break
+            batch = [request]
+            bases = request.bases
+            deadline = time.monotonic() + self._max_wait
+            while bases < self._batch_bases:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                bases += request.bases
+            self._classify_batch(batch, bases)
+
+    def _classify_batch(self, batch, bases):
+        self.n_batches += 1
+        logger.debug("Classifying a batch of %d requests, %d bases", len(batch), bases)
+        try:
+            records = [record for request in batch if request.window is None for record in request.records]
+            chunk_bases = utils.default_chunk_bases(bases, self._classifier._n_procs)
+            results = list(self._classifier.classify_stream(iter(records), max(bases, 1), chunk_bases))
+            start = 0
+            for request in batch:
+                if request.window is None:
+                    request.results = results[start:start + len(request.records)]
+                    start += len(request.records)
+                else:
+                    request.results = list(self._classifier.classify_windows_stream(
+                        iter(request.records), request.window, request.step, max(request.bases, 1), chunk_bases))
+        except Exception as e:
+            logger.exception("Classifying a batch failed")
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
+
+
+class _Request():
+    def __init__(self, records, window=None, step=None):
+        self.records = records
+        self.window = window
+        self.step = step
+        self.bases = sum([len(seq) for _, seq in records])
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serve classification requests with the classifier and batcher of the server
+    '''
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, b'ok\n')
+        elif self.path == '/metrics':
+            self._reply(200, json.dumps(self.server.classifier.metrics.to_dict()).encode(), 'application/json')
+        else:
+            self._reply(404, b'Not found\n')
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/classify':
+            self._reply(404, b'Not found\n')
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            columns = [column for column in query.get('columns', [''])[0].split(',') if column]
+            for column in columns:
+                if column not in COLUMNS:
+                    raise ValueError('Unknown column {}, not one of {}'.format(column, ','.join(COLUMNS)))
+            window = int(query['window'][0]) if 'window' in query else None
+            step = int(query['step'][0]) if 'step' in query else None
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                records = utils.read_fastx(json.loads(body.decode())['path'])
+            else:
+                records = utils.parse_fastx(body)
+            records = [(name, seq) for name, seq, _ in records]
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self._reply(400, 'Bad request: {}\n'.format(e).encode())
+            return
+        try:
+            results = self.server.batcher.classify(records, window, step)
+        except Exception as e:
+            self._reply(500, 'Classification failed: {}\n'.format(e).encode())
+            return
+        if window is not None:
+            lines = ['{}\t{}\t{}\t{}\n'.format(name, start, end, p)
+                     for name, (starts, ends, probs) in results for start, end, p in zip(starts, ends, probs)]
+        elif columns:
+            c = self.server.classifier
+            lines = [name + '\t' + str(p) + ''.join(['\t{}'.format(len(seq) if column == 'length' else c._get_scale(len(seq)))
+                                                    for column in columns]) + '\n'
+                     for (name, p), (_, seq) in zip(results, records)]
+        else:
+            lines = [name + '\t' + str(p) + '\n' for name, p in results]
+        self._reply(200, ''.join(lines).encode(), 'text/tab-separated-values')
+
+    def _reply(self, code, body, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(classifier, socket_path=None, host='127.0.0.1', port=DEFAULT_PORT, max_wait=0.005, batch_bases=10000000):
+    ''' Create a server of the classifier on a Unix socket, or on host and port
+    Run it with serve_forever() and stop it with shutdown(), then close_server()
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            if _socket_in_use(socket_path):
+                raise OSError('A server is already listening on {}'.format(socket_path))
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.socket_path = socket_path
+    server.classifier = classifier
+    server.batcher = Batcher(classifier, max_wait, batch_bases)
+    return server
+
+
+def close_server(server):
+    ''' Close a server made by make_server, after it has been shut down
+    The classifier is left open
+    '''
+    server.server_close()
+    server.batcher.close()
+    if server.socket_path is not None and os.path.exists(server.socket_path):
+        os.remove(server.socket_path)
+
+
+def _socket_in_use(socket_path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    ''' An HTTP connection over a Unix socket
+    '''
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+def request(method, url, body=None, headers={}, socket_path=None, host='127.0.0.1', port=DEFAULT_PORT, timeout=None):
+    ''' Send a request to a server on a Unix socket, or on host and port
+    Returns the response body, raising RuntimeError if the request failed
+    '''
+    if socket_path is not None:
+        conn = UnixHTTPConnection(socket_path, timeout)
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError('Request failed ({}): {}'.format(response.status, data.decode(errors='replace').strip()))
+    return data
+
+
+def classify_remote(path=None, data=None, columns=(), window=None, step=None, **server):
+    ''' Classify the records of a fasta or fastq file with a server
+    Sends the path for the server to read, or the file contents in data
+    The server keyword arguments (socket_path, host, port, timeout) are passed to request
+    Returns the (name, score) lines as bytes, followed by the extra COLUMNS given,
+    or with a window length the (name, start, end, score) bedGraph lines of the windows
+    '''
+    query = {}
+    if columns: query['columns'] = ','.join(columns)
+    if window is not None: query['window'] = window
+    if step is not None: query['step'] = step
+    url = '/classify' + ('?' + urllib.parse.urlencode(query) if query else '')
+    if data is not None:
+        return request('POST', url, data, {'Content-Type': 'application/octet-stream'}, **server)
+    body = json.dumps({'path': os.path.abspath(path)}).encode()
+    return request('POST', url, body, {'Content-Type': 'application/json'}, **server)
+
+
+def main(args):
+    ''' Load the classifier and serve requests until interrupted
+    '''
+    with plasclass.plasclass(args.num_processes, cache_dir=args.cache, cache_size=args.cache_size, dtype=args.precision) as c:
+        server = make_server(c, args.socket, args.host, args.port, args.max_wait / 1000., args.batch_bases)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info("Serving on %s", args.socket if args.socket else '{}:{}'.format(args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_server(server)
+            logger.info("Server stopped")
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Serve PlasClass classification requests over a Unix socket or localhost HTTP',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('-s','--socket',
+     help='Unix socket to listen on, instead of HTTP on host and port',
+     required=False, type=str
+     )
+    parser.add_argument('--host',
+     help='host to listen on',
+     required=False, type=str, default='127.0.0.1'
+     )
+    parser.add_argument('--port',
+     help='port to listen on',
+     required=False, type=int, default=DEFAULT_PORT
+     )
+    parser.add_argument('-p','--num_processes',
+     help='Number of processes to use',
+     required=False, type=int, default=8
+     )
+    parser.add_argument('--cache',
+     help='Directory of a persistent cache of results',
+     required=False, type=str
+     )
+    parser.add_argument('--cache_size',
+     help='Maximum number of sequences in the cache',
+     required=False, type=int, default=10000000
+     )
+    parser.add_argument('--precision',
+     help='Precision of the k-mer frequencies and model weights',
+     required=False, type=str, choices=['float64', 'float32'], default='float64'
+     )
+    parser.add_argument('--max_wait',
+     help='Milliseconds to wait for more requests to batch with the first',
+     required=False, type=float, default=5.
+     )
+    parser.add_argument('--batch_bases',
+     help='Maximum number of bases in a batch of requests',
+     required=False, type=int, default=10000000
+     )
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+    main(parser.parse_args())
@@ -5,20 +5,29 @@
 ##
 
 import argparse
+import collections
+import concurrent.futures
 
 import numpy as np
 import os
+import sys
+import threading
 
-import random
-
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import log_loss
+from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from joblib import dump
 
 import multiprocessing as mp
-from multiprocessing import Manager
+
+import sklearn
 
 import plasclass_utils as utils
+import model_bundle as bundle
+import feature_store
+
+# the logistic loss of SGDClassifier is 'log_loss' since scikit-learn 1.1, and 'log' was removed in 1.3
+SGD_LOG_LOSS = 'log_loss' if tuple([int(v) for v in sklearn.__version__.split('.')[:2]]) >= (1, 1) else 'log'
 
 def parse_user_input():
 
@@ -28,11 +37,11 @@ def parse_user_input():
         )
     parser.add_argument('-p','--plasmid',
      help='plasmid file - file of plasmid reference sequences',
-     required=True, type=str
+     required=False, type=str
      )
     parser.add_argument('-c','--chromosome',
      help='chromosome file - file of chromosome reference sequences',
-     required=True, type=str
+     required=False, type=str
      )
     parser.add_argument('-o','--outdir',
      help='output directory',
@@ -50,6 +59,47 @@ def parse_user_input():
      help='comma-separated list of sequence length bins',
      required=False, type=str, default='1000,10000,100000,500000'
      )
+    parser.add_argument('--max_memory','--max-memory',
+     help='train out of core using about this many megabytes of memory: features are '
+          'stored on disk and the classifier is fit by stochastic gradient descent',
+     required=False, type=int
+     )
+    parser.add_argument('--epochs',
+     help='number of passes over the features when training out of core',
+     required=False, type=int, default=10
+     )
+    parser.add_argument('--Cs',
+     help='comma-separated list of inverse regularization strengths to choose from for each length, '
+          'by cross-validation (or by the held-out loss when training out of core)',
+     required=False, type=str
+     )
+    parser.add_argument('--cv',
+     help='number of cross-validation folds when choosing from --Cs',
+     required=False, type=int, default=5
+     )
+    parser.add_argument('--fit_procs','--fit-procs',
+     help='maximum number of models fit at once (default: the number of processes). Each in-memory fit '
+          'holds a standardized copy of its features, and out of core the fits share --max_memory',
+     required=False, type=int
+     )
+    parser.add_argument('--seed',
+     help='random seed, for reproducible models',
+     required=False, type=int
+     )
+    parser.add_argument('--save_features','--save-features',
+     help='save the k-mer frequencies of the training fragments of each length to this directory, '
+          'with the fragment names, lengths and labels, to train again without counting',
+     required=False, type=str
+     )
+    parser.add_argument('--load_features','--load-features',
+     help='train on the fragment features saved to this directory with --save_features, instead '
+          'of sampling and counting fragments of the plasmid and chromosome files',
+     required=False, type=str
+     )
+    parser.add_argument('--pickle',
+     help='also save the sklearn scalers and classifiers as joblib pickles',
+     required=False, action='store_true'
+     )
 
     return parser.parse_args()
 
@@ -59,11 +109,9 @@ def get_seq_lengths(infile):
     '''
     sequence_names = []
     sequence_lengths = []
-    fp = open(infile)
-    for name, seq, _ in utils.readfq(fp):
+    for name, seq, _ in utils.read_fastx(infile):
         sequence_names.append(name)
         sequence_lengths.append(len(seq))
-    fp.close()
 
     return sequence_names, sequence_lengths
 
@@ -80,103 +128,478 @@ def get_num_frags(seq_lengths, length, coverage=5):
     return num_frags
 
 
-def get_start_inds(seq_names, seq_lengths, num_frags, length):
+def get_start_inds(seq_names, seq_lengths, num_frags, length, rng=None):
     ''' Randomly simulate fragments of a specific length from the sequences
+        Genomes are chosen in proportion to their length and start indices uniformly,
+        in one vectorized draw from the numpy Generator rng
     '''
+    if rng is None: rng = np.random.default_rng()
     # filter out sequences that are significantly shorter than the length
-    filtered_seq_names = [seq_names[i] for i,v in enumerate(seq_lengths) if v > 0.85*length]
-    filtered_seq_lengths = [l for l in seq_lengths if l > 0.85*length]
+    filtered = [i for i,v in enumerate(seq_lengths) if v > 0.85*length]
+    inds_dict = {seq_names[i]: [] for i in filtered}
+    if not filtered: return inds_dict
+    filtered_seq_lengths = np.array([seq_lengths[i] for i in filtered], dtype=np.int64)
+    length_fractions = filtered_seq_lengths / float(filtered_seq_lengths.sum())
+
+    # choose genomes, then start indices in the genomes
+    seq_inds = rng.choice(len(filtered), size=num_frags, p=length_fractions)
+    frag_seq_lengths = filtered_seq_lengths[seq_inds]
+    start_inds = rng.integers(0, frag_seq_lengths)
+    start_inds[frag_seq_lengths < length] = 0 # just take the whole thing
+
+    order = np.argsort(seq_inds, kind='stable')
+    bounds = np.searchsorted(seq_inds[order], np.arange(len(filtered) + 1))
+    for j, i in enumerate(filtered):
+        inds_dict[seq_names[i]] = start_inds[order[bounds[j]:bounds[j+1]]].tolist()
+    return inds_dict
 
-    tot_seq_len = sum(filtered_seq_lengths)
 
-    length_fractions = [float(l)/float(tot_seq_len) for l in filtered_seq_lengths]
+def get_seqs(infile, inds_dict, l):
+    ''' Create array of the sequences
+    '''
+    return get_all_seqs(infile, {l: inds_dict})[l]
 
-    inds_dict = {}
-    for name in filtered_seq_names:
-        inds_dict[name] = []
 
-    for i in range(num_frags):
-        # choose genome
-        seq_ind = np.random.choice(len(filtered_seq_names),p=length_fractions)
-        seq_len = filtered_seq_lengths[seq_ind]
-        seq_name = filtered_seq_names[seq_ind]
-        # choose start index in the genome
-        if seq_len < length: # just take the whole thing
-            inds_dict[seq_name].append(0)
-        else:
-            start_ind = random.randint(0,seq_len - 1)
-            inds_dict[seq_name].append(start_ind)
+def get_all_seqs(infile, inds_by_length):
+    ''' Cut out the fragments of all the lengths in a single pass over infile
+        inds_by_length maps each length to its dictionary of start indices
+        Returns a dictionary of the fragment lists of each length
+    '''
+    seqs = {l: [] for l in inds_by_length}
+    for l, frag in iter_frags(infile, inds_by_length):
+        seqs[l].append(frag)
+    return seqs
 
-    return inds_dict
 
+def iter_frags(infile, inds_by_length):
+    ''' Generate the (length, fragment) pairs one reference sequence at a time
+        Fragments are zero-copy memoryview slices of the reference, except those that wrap
+        around the end of a circular reference
+    '''
+    for name,seq,_ in utils.read_fastx(infile):
+        view = memoryview(seq)
+        for l, inds_dict in inds_by_length.items():
+            for start_ind in inds_dict.get(name, []):
+                frag = view[start_ind:start_ind+l]
+                if len(frag) < l and len(seq) > l:
+                    frag = seq[start_ind:] + seq[:l-len(frag)]
+                yield l, frag
+
+
+def fragment_features(pool, plasfile, chromfile, plas_start_inds, chrom_start_inds, n_features, num_procs,
+                      chunk_bases, workdir=None, rng=None):
+    ''' Compute the k-mer frequencies of the plasmid and chromosome fragments of all lengths
+        plas_start_inds and chrom_start_inds map each length to its start indices
+        The matrices are shared float64 arrays with the plasmid fragments first, in the order of
+        iter_frags. If workdir is given they are instead memory-mapped float32 stores in workdir
+        with the rows in random order (for training out of core)
+        Returns a dictionary of (matrix descriptor, matrix, labels, rows) for each length, where
+        rows are the matrix rows of the fragments in the order of iter_frags
+    '''
+    if rng is None: rng = np.random.default_rng()
+    features = {}
+    try:
+        plas_stores = {}
+        chrom_stores = {}
+        for l in plas_start_inds:
+            n_plas = sum([len(v) for v in plas_start_inds[l].values()])
+            n_chrom = sum([len(v) for v in chrom_start_inds[l].values()])
+            shape = (n_plas + n_chrom, n_features)
+            if workdir is not None:
+                rows = rng.permutation(n_plas + n_chrom)
+                desc = (os.path.join(workdir, 'features_{}.f32'.format(l)), np.dtype(np.float32).str, shape)
+                store = np.memmap(desc[0], dtype=np.float32, mode='w+', shape=shape)
+            else:
+                rows = np.arange(n_plas + n_chrom)
+                desc, store = utils.create_shared_array(shape)
+            labels = np.zeros(n_plas + n_chrom)
+            labels[rows[:n_plas]] = 1
+            features[l] = (desc, store, labels, rows)
+            plas_stores[l] = (desc, rows[:n_plas])
+            chrom_stores[l] = (desc, rows[n_plas:])
+
+        featurize_fragments(pool, plasfile, plas_start_inds, plas_stores, num_procs, chunk_bases)
+        featurize_fragments(pool, chromfile, chrom_start_inds, chrom_stores, num_procs, chunk_bases)
+    except BaseException:
+        remove_features(features)
+        raise
+    return features
+
+
+def remove_features(features):
+    ''' Remove the files backing the feature matrices returned by fragment_features
+    '''
+    for desc, _, _, _ in features.values():
+        if desc is not None: utils.remove_shared_array(desc)
 
-def get_seqs(infile, inds_dict, l):
-    ''' Create array of the sequences
+
+def fragment_names(start_inds, l, seq_names, seq_lengths):
+    ''' The names ('<reference>:<start>') and lengths of the fragments of length l, given by the
+        start indices of each reference, in the order of iter_frags
     '''
-    seqs = []
-    fp = open(infile)
-    for name,seq,_ in utils.readfq(fp):
-        start_inds = inds_dict.get(name, [])
-        for start_ind in start_inds:
-            frag = seq[start_ind:start_ind+l]
-            if len(frag) < l and len(seq) > l:
-                frag += seq[:l-len(frag)]
-            seqs.append(frag)
-    fp.close()
-    return seqs
+    names, lengths = [], []
+    for name, seq_length in zip(seq_names, seq_lengths):
+        for start_ind in start_inds.get(name, []):
+            names.append('{}:{}'.format(name, start_ind))
+            # as in featurize_fragments, only fragments of references longer than l wrap around
+            lengths.append(l if seq_length > l else min(start_ind + l, seq_length) - start_ind)
+    return names, lengths
+
+
+def save_fragment_features(path, ks, n_features, features, fragments):
+    ''' Save the fragment features of each length returned by fragment_features as a feature store
+        fragments maps each length to the names and lengths of its fragments in the order of iter_frags
+    '''
+    print("Saving features in {}".format(path))
+    writer = feature_store.FeatureWriter(path, ks, n_features)
+    for l, (_, data, labels, rows) in features.items():
+        names, lengths = np.empty(len(rows), dtype=object), np.zeros(len(rows), dtype=np.int64)
+        names[rows], lengths[rows] = fragments[l]
+        writer.add_matrix(l, data, names, lengths, labels)
+    writer.close()
+
+
+def load_fragment_features(path, ks, lens, workdir=None, rng=None, block_rows=10000):
+    ''' Load the fragment features of each length saved by save_fragment_features, memory-mapped
+        The saved rows are in reference order, plasmids first. Training out of core takes its
+        chunks and held-out rows in row order, so given a workdir the rows of each length are
+        copied in random order (from rng) to a float32 matrix there, as in fragment_features
+    '''
+    print("Loading features from {}".format(path))
+    store = feature_store.FeatureStore(path)
+    if list(store.ks) != list(ks):
+        raise ValueError('Features in {} were counted with ks={}, not {}'.format(path, store.ks, ks))
+    for l in lens:
+        if l not in store.scales:
+            raise ValueError('Features in {} have no fragments of length {}'.format(path, l))
+    if workdir is None:
+        return {l: (None, store.matrix(l), store.labels(l), None) for l in lens}
+
+    if rng is None: rng = np.random.default_rng()
+    features = {}
+    try:
+        for l in lens:
+            data = store.matrix(l)
+            rows = rng.permutation(len(data))
+            desc = (os.path.join(workdir, 'features_{}.f32'.format(l)), np.dtype(np.float32).str, data.shape)
+            shuffled = np.memmap(desc[0], dtype=np.float32, mode='w+', shape=data.shape)
+            features[l] = (desc, shuffled, store.labels(l)[rows], None)
+            for start in range(0, len(rows), block_rows):
+                shuffled[start:start + block_rows] = data[rows[start:start + block_rows]]
+            shuffled.flush()
+    except BaseException:
+        remove_features(features)
+        raise
+    return features
+
+
+def featurize_fragments(pool, infile, start_inds, stores, num_procs, chunk_bases):
+    ''' Compute the k-mer frequencies of the fragments of the references in infile, counting each
+        reference once rather than each fragment
+        start_inds maps each length to its start indices, and stores maps each length to
+        (matrix descriptor, rows): the i-th fragment of that length, in the order of iter_frags,
+        is written to row rows[i] of the shared matrix
+        Each reference is split into stretches of about chunk_bases fragment starts, which the
+        workers count (see utils.fragment_freqs_chunk). A reference is extended by its start so that
+        fragments wrapping around its end are ranges of the extended sequence
+    '''
+    lens = list(start_inds)
+    done = {l: 0 for l in lens}
+    pending = collections.deque()
+    for name,seq,_ in utils.read_fastx(infile):
+        starts, ends, targets, rows = [], [], [], []
+        for t, l in enumerate(lens):
+            frag_starts = np.array(start_inds[l].get(name, []), dtype=np.int64)
+            if len(frag_starts) == 0: continue
+            starts.append(frag_starts)
+            ends.append(frag_starts + l if len(seq) > l else np.minimum(frag_starts + l, len(seq)))
+            targets.append(np.full(len(frag_starts), t))
+            rows.append(stores[l][1][done[l]:done[l]+len(frag_starts)])
+            done[l] += len(frag_starts)
+        if not starts: continue
+        starts, ends, targets, rows = [np.concatenate(a) for a in (starts, ends, targets, rows)]
+        if ends.max() > len(seq): # fragments wrap around the end of a circular reference
+            seq = seq + seq[:ends.max() - len(seq)]
+
+        order = np.argsort(starts, kind='stable')
+        stretches = np.split(order, np.flatnonzero(np.diff(starts[order] // chunk_bases)) + 1)
+        for stretch in stretches:
+            lo, hi = starts[stretch[0]], ends[stretch].max()
+            stretch_targets = []
+            for t, l in enumerate(lens):
+                frags = stretch[targets[stretch] == t]
+                if len(frags) > 0:
+                    stretch_targets.append((stores[l][0], rows[frags], starts[frags] - lo, ends[frags] - lo))
+            while len(pending) >= 2 * num_procs: # bound the stretches held in the task queue
+                pending.popleft().get()
+            pending.append(pool.apply_async(utils.fragment_freqs_chunk, ([seq[lo:hi], stretch_targets],)))
+    while pending:
+        pending.popleft().get()
+
+
+def fit_out_of_core(store, labels, l, max_memory, epochs=10, holdout=0.1, rng=None, C=1.):
+    ''' Train the scaler and classifier of one length from a feature store with bounded memory
+        The scaler is fit with a single partial_fit pass and the logistic regression by stochastic
+        gradient descent over chunks of rows. The rows are in random order, and the last
+        holdout fraction is used to report the accuracy
+        max_memory is in megabytes, and C is the inverse regularization strength
+        Returns the scaler, the classifier and the held-out log loss (None without held-out rows)
+    '''
+    if rng is None: rng = np.random.default_rng()
+    n_rows, n_features = store.shape
+    # a chunk of rows is held as float32, float64 and standardized float64
+    chunk_rows = max(1, int(max_memory * 2**20 // (2 * 20 * n_features)))
+    n_train = n_rows - int(holdout * n_rows)
+    train_chunks = [(i, min(i + chunk_rows, n_train)) for i in range(0, n_train, chunk_rows)]
+
+    print("Learning classifier for length {}".format(l))
+    scaler = StandardScaler()
+    for start, end in train_chunks:
+        scaler.partial_fit(store[start:end].astype(np.float64))
+    # same objective as LogisticRegression(C=C): alpha = 1/(C * n_samples)
+    clf = SGDClassifier(loss=SGD_LOG_LOSS, alpha=1./(C * n_train), tol=None, random_state=int(rng.integers(2**31)))
+    for epoch in range(epochs):
+        for c in rng.permutation(len(train_chunks)):
+            start, end = train_chunks[c]
+            clf.partial_fit(scaler.transform(store[start:end].astype(np.float64)), labels[start:end], classes=[0., 1.])
+
+    loss = None
+    if n_train < n_rows:
+        correct = 0
+        loss = 0.
+        for start in range(n_train, n_rows, chunk_rows):
+            end = min(start + chunk_rows, n_rows)
+            scaled = scaler.transform(store[start:end].astype(np.float64))
+            correct += clf.score(scaled, labels[start:end]) * (end - start)
+            loss += log_loss(labels[start:end], clf.predict_proba(scaled), labels=[0., 1.], normalize=False)
+        loss /= n_rows - n_train
+        print("Held-out accuracy for length {} with C={}: {:.4f}".format(l, C, correct / (n_rows - n_train)))
+    return scaler, clf, loss
+
+
+def fit_in_memory(data, labels, C=1.):
+    ''' Train the scaler and classifier of one length with all the features in memory
+    '''
+    print("Learning classifier")
+    scaler = StandardScaler().fit(data)
+    scaled = scaler.transform(data)
+    clf = LogisticRegression(solver='liblinear', C=C).fit(scaled,labels)
+    return scaler, clf
+
+
+def cv_fold_loss(data, labels, C, fold, n_folds, seed):
+    ''' The log loss on one fold of a stratified n_folds-fold split of the rows, of a scaler and
+        classifier with inverse regularization strength C fit in memory on the other folds
+    '''
+    folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    train_rows, test_rows = list(folds.split(np.zeros(len(labels)), labels))[fold]
+    scaler = StandardScaler().fit(data[train_rows])
+    clf = LogisticRegression(solver='liblinear', C=C).fit(scaler.transform(data[train_rows]), labels[train_rows])
+    return log_loss(labels[test_rows], clf.predict_proba(scaler.transform(data[test_rows])), labels=[0., 1.])
+
+
+def matrix_source(data):
+    ''' A picklable reference to a feature matrix for the pool workers: the file, dtype, shape and
+        offset of a memory-mapped matrix, so that the workers map it rather than copy it, or else
+        the matrix itself
+    '''
+    if isinstance(data, np.memmap) and data.filename is not None:
+        return (data.filename, data.dtype.str, data.shape, data.offset)
+    return data
+
+
+def open_matrix(source):
+    ''' Open a feature matrix from its matrix_source, read-only
+    '''
+    if isinstance(source, tuple):
+        filename, dtype, shape, offset = source
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return source
+
+
+def fit_task(source, labels, l, C, max_memory, epochs, seed):
+    ''' Pool task: fit the scaler and classifier of length l on the matrix of source
+        Returns the scaler, classifier and held-out log loss (see fit_out_of_core)
+    '''
+    data = open_matrix(source)
+    if max_memory is not None:
+        return fit_out_of_core(data, labels, l, max_memory, epochs, rng=np.random.default_rng(seed), C=C)
+    return fit_in_memory(data, labels, C) + (None,)
+
+
+def cv_task(source, labels, C, fold, n_folds, seed):
+    ''' Pool task: the log loss of one cross-validation fold (see cv_fold_loss)
+    '''
+    return cv_fold_loss(open_matrix(source), labels, C, fold, n_folds, seed)
+
 
+class BoundedTasks():
+    ''' Run tasks in a pool with at most limit of them running at once, the others waiting in
+        the order they were submitted. Returns a concurrent.futures.Future for each task
+    '''
+    def __init__(self, pool, limit=None):
+        self._pool = pool
+        self._limit = limit
+        self._waiting = collections.deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, args):
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._waiting.append((func, args, future))
+        self._start()
+        return future
+
+    def _start(self):
+        with self._lock:
+            while self._waiting and (self._limit is None or self._running < self._limit):
+                func, args, future = self._waiting.popleft()
+                self._running += 1
+                self._pool.apply_async(func, args, callback=lambda result, future=future: self._done(future, result),
+                                       error_callback=lambda e, future=future: self._done(future, error=e))
+
+    def _done(self, future, result=None, error=None):
+        # called in the result thread of the pool, which starts the next waiting tasks
+        with self._lock:
+            self._running -= 1
+        try:
+            self._start()
+        finally:
+            if error is not None: future.set_exception(error)
+            else: future.set_result(result)
+
+
+def fit_models(pool, features, lens, max_memory=None, epochs=10, Cs=None, cv=5, rng=None, fit_procs=None):
+    ''' Fit the scaler and classifier of each length concurrently in the worker pool, running
+        at most fit_procs fits (or cross-validation folds) at once if given
+        features maps each length to its (descriptor, matrix, labels, rows), as returned by
+        fragment_features. The workers map the matrices rather than copying them
+        With several inverse regularization strengths Cs, the best of each length is chosen:
+        in memory by the mean log loss of cv-fold cross-validation, whose folds run in
+        parallel, and each length is refit with its best C as soon as its folds are done. Out of
+        core by the loss on the held-out rows of a model fit with each C, keeping the best
+        Out of core, max_memory is shared by the fits running at once
+        Returns a dictionary of (scaler, classifier) for each length
+    '''
+    if rng is None: rng = np.random.default_rng()
+    Cs = list(Cs) if Cs else [1.]
+    seeds = {l: int(seed) for l, seed in zip(lens, rng.integers(2**31, size=len(lens)))}
+    sources = {l: matrix_source(features[l][1]) for l in lens}
+    labels = {l: features[l][2] for l in lens}
+    tasks = BoundedTasks(pool, fit_procs)
+
+    if max_memory is not None or len(Cs) == 1:
+        if max_memory is not None:
+            max_memory = max_memory / min(len(lens) * len(Cs), fit_procs or len(lens) * len(Cs))
+        fits = {(l, C): tasks.submit(fit_task, (sources[l], labels[l], l, C, max_memory, epochs, seeds[l]))
+                for l in lens for C in Cs}
+        models = {}
+        for l in lens:
+            results = [fits[(l, C)].result() for C in Cs]
+            best = int(np.argmin([loss for _, _, loss in results])) if results[0][2] is not None else 0
+            if len(Cs) > 1: print("Best C for length {}: {}".format(l, Cs[best]))
+            models[l] = results[best][:2]
+        return models
+
+    folds = {(l, C, fold): tasks.submit(cv_task, (sources[l], labels[l], C, fold, cv, seeds[l]))
+             for l in lens for C in Cs for fold in range(cv)}
+    fits = {}
+    for l in lens:
+        losses = [np.mean([folds[(l, C, fold)].result() for fold in range(cv)]) for C in Cs]
+        for C, loss in zip(Cs, losses):
+            print("Cross-validated log loss for length {} with C={}: {:.4f}".format(l, C, loss))
+        best = Cs[int(np.argmin(losses))]
+        print("Best C for length {}: {}".format(l, best))
+        fits[l] = tasks.submit(fit_task, (sources[l], labels[l], l, best, None, epochs, seeds[l]))
+    return {l: fits[l].result()[:2] for l in lens}
 
-def train(plasfile, chromfile, outdir, num_procs, ks=[3,4,5,6,7], lens=[1000,10000,100000,500000]):
+
+def train(plasfile, chromfile, outdir, num_procs, ks=[3,4,5,6,7], lens=[1000,10000,100000,500000], pickle=False,
+          max_memory=None, epochs=10, seed=None, save_features=None, load_features=None, Cs=None, cv=5, fit_procs=None):
     ''' Train PlasClass models
+    Writes the model bundle models.pcb in outdir, and optionally the joblib pickles
+    If max_memory (megabytes) is given, train out of core (see fit_out_of_core)
+    seed makes the fragment sampling, and so the models, reproducible
+    The fragment features can be saved to the directory save_features, and loaded from the
+    directory load_features instead of sampling and counting fragments
+    A single worker pool counts the fragments of all the lengths, then fits the models of the
+    lengths concurrently, at most fit_procs (by default num_procs) at once, choosing the
+    regularization of each from Cs (see fit_models)
     '''
     print("Starting PlasClass training")
+    rng = np.random.default_rng(seed)
+    pool = mp.Pool(num_procs, initializer=utils.init_worker, initargs=(ks,))
+    features = {}
+    try:
+        if load_features is not None:
+            features = load_fragment_features(load_features, ks, lens, outdir if max_memory is not None else None, rng)
+        else:
+            features = sample_fragment_features(pool, plasfile, chromfile, outdir, num_procs, ks, lens, max_memory, rng,
+                                                save_features)
+        fitted = fit_models(pool, features, lens, max_memory, epochs, Cs, cv, rng, min(fit_procs or num_procs, num_procs))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally: # the feature stores are removed even if training failed
+        pool.join()
+        remove_features(features)
+
+    models = {}
+    for l in lens:
+        scaler, clf = fitted[l]
+        models[l] = bundle.sklearn_params(scaler, clf)
+        if pickle:
+            from joblib import dump
+            print("Saving classifier")
+            clf_name = 'm'+str(l)
+            scaler_name = 's'+str(l)
+            dump(clf, os.path.join(outdir,clf_name))
+            dump(scaler, os.path.join(outdir,scaler_name))
+
+    print("Saving model bundle")
+    bundle.write_bundle(os.path.join(outdir,'models.pcb'), ks, models)
+
+
+def sample_fragment_features(pool, plasfile, chromfile, outdir, num_procs, ks, lens, max_memory, rng, save_features=None):
+    ''' Sample the training fragments of each length from the references and compute their features
+    (see fragment_features), saving them to the directory save_features if given
+    '''
     print("Getting reference lengths")
     chrom_names, chrom_lengths = get_seq_lengths(chromfile)
     plas_names, plas_lengths = get_seq_lengths(plasfile)
+    _, kmer_count_lens = utils.kmer_index_tables(ks)
+    n_features = sum([kmer_count_lens[k] for k in ks])
+
+    plas_start_inds = {}
+    chrom_start_inds = {}
     for l in lens:
         coverage=5 # TODO: make this command line option
         num_frags = get_num_frags(plas_lengths,l,coverage)
-
         print("Sampling {} fragments for length {}".format(num_frags,l))
-        plas_start_inds = get_start_inds(plas_names, plas_lengths, num_frags, l)
-        chrom_start_inds = get_start_inds(chrom_names, chrom_lengths, num_frags, l)
-        plas_seqs = get_seqs(plasfile, plas_start_inds, l)
-        chrom_seqs = get_seqs(chromfile, chrom_start_inds, l)
-
-        print("Getting k-mer frequencies")
-        kmer_inds, kmer_count_lens = utils.compute_kmer_inds(ks)
-
-        pool = mp.Pool(num_procs)
-        plas_list=Manager().list()
-        for cur in np.arange(len(plas_seqs)):
-            plas_list.append(0)
-        pool.map(utils.count_kmers, [[ind,s, ks, kmer_inds, kmer_count_lens, plas_list] \
-                                        for ind,s in enumerate(plas_seqs)])
-        plas_freqs = np.array(plas_list)
-
-        chrom_list=Manager().list()
-        for cur in np.arange(len(chrom_seqs)):
-            chrom_list.append(0)
-        pool.map(utils.count_kmers, [[ind, s, ks, kmer_inds, kmer_count_lens, chrom_list] \
-                                        for ind,s in enumerate(chrom_seqs)])
-        chrom_freqs = np.array(chrom_list)
-
-        pool.close()
-
-        print("Learning classifier")
-        plas_labels = np.ones(plas_freqs.shape[0])
-        chrom_labels = np.zeros(chrom_freqs.shape[0])
-        data = np.concatenate((plas_freqs,chrom_freqs))
-        labels = np.concatenate((plas_labels, chrom_labels))
-        scaler = StandardScaler().fit(data)
-        scaled = scaler.transform(data)
-        clf = LogisticRegression(solver='liblinear').fit(scaled,labels)
-
-        print("Saving classifier")
-        clf_name = 'm'+str(l)
-        scaler_name = 's'+str(l)
-        dump(clf, os.path.join(outdir,clf_name))
-        dump(scaler, os.path.join(outdir,scaler_name))
+        plas_start_inds[l] = get_start_inds(plas_names, plas_lengths, num_frags, l, rng)
+        chrom_start_inds[l] = get_start_inds(chrom_names, chrom_lengths, num_frags, l, rng)
+
+    print("Getting k-mer frequencies")
+    chunk_bases = utils.default_chunk_bases(max(sum(plas_lengths), sum(chrom_lengths)), num_procs, 4 * max(lens))
+    if max_memory is not None: # each worker holds a stretch and its k-mer tracks, about 40 bytes per base
+        chunk_bases = min(chunk_bases, max(4 * max(lens), max_memory * 2**20 // (40 * num_procs)))
+    features = fragment_features(pool, plasfile, chromfile, plas_start_inds, chrom_start_inds, n_features, num_procs,
+                                 chunk_bases, outdir if max_memory is not None else None, rng)
+
+    if save_features is not None:
+        try:
+            fragments = {}
+            for l in lens:
+                plas_frags = fragment_names(plas_start_inds[l], l, plas_names, plas_lengths)
+                chrom_frags = fragment_names(chrom_start_inds[l], l, chrom_names, chrom_lengths)
+                fragments[l] = (plas_frags[0] + chrom_frags[0], plas_frags[1] + chrom_frags[1])
+            save_fragment_features(save_features, ks, n_features, features, fragments)
+        except BaseException:
+            remove_features(features)
+            raise
+    return features
 
 
 def main(args):
@@ -188,8 +611,13 @@ def main(args):
     lens = [int(s) for s in args.lengths.split(',')]
     num_procs = args.num_processes
     outdir = args.outdir
+    if args.load_features is None and (plasfile is None or chromfile is None):
+        sys.exit('The plasmid (-p) and chromosome (-c) files are needed unless features are loaded (--load_features)')
+
+    Cs = [float(C) for C in args.Cs.split(',')] if args.Cs else None
 
-    train(plasfile,chromfile,outdir,num_procs,ks,lens)
+    train(plasfile,chromfile,outdir,num_procs,ks,lens,args.pickle,args.max_memory,args.epochs,args.seed,
+          args.save_features,args.load_features,Cs,args.cv,args.fit_procs)
 
 if __name__=='__main__':
     args = parse_user_input()
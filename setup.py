@@ -13,17 +13,19 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/Shamir-Lab/PlasClass",
     packages=['plasclass'],
-    scripts=['classify_fasta.py', 'plasclass/train.py'],
+    scripts=['classify_fasta.py', 'classify_client.py', 'plasclass/train.py'],
     classifiers=[
         "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
     install_requires=[
-        'scipy==1.10.0',
-        'scikit-learn==0.21.3',
-        'joblib==1.2.0',
         'numpy==1.22.0'],
+    extras_require={
+        'train': [
+            'scipy==1.10.0',
+            'scikit-learn==0.21.3',
+            'joblib==1.2.0']},
     package_data={'plasclass': ['data/*']},
     include_package_data=True,
 )
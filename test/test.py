@@ -52,10 +52,702 @@ def test_module():
         print('TEST FAILED!')
         exit(-1)
 
+def test_count_kmers_equivalence():
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    ks = [3,4,5,6,7]
+    kmer_inds, kmer_count_lens = utils.compute_kmer_inds(ks)
+    kmer_ind_arrays = utils.kmer_ind_arrays(kmer_inds, ks)
+    rng = np.random.RandomState(0)
+    seqs = [seq for _, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))][:20]
+    for i in range(20): # random sequences with runs of ambiguous bases
+        seq = rng.choice(list('ACGT'), rng.randint(100, 10000))
+        for start in rng.randint(0, len(seq)-20, 5):
+            seq[start:start+rng.randint(1,12)] = 'N'
+        seq[:7] = 'A'
+        seq[-7:] = 'C'
+        seqs.append(''.join(seq))
+    for seq in seqs:
+        ref, new = [0], [0]
+        utils.count_kmers_reference([0, seq, ks, kmer_inds, kmer_count_lens, ref])
+        utils.count_kmers([0, seq, ks, kmer_ind_arrays, kmer_count_lens, new])
+        assert np.array_equal(ref[0], new[0])
+        codes = utils.encode_seq(seq)
+        derived = utils.count_kmer_codes_derived(codes, ks, kmer_ind_arrays, kmer_count_lens)
+        for k in ks:
+            assert np.array_equal(derived[k], utils.count_kmer_codes(codes, k, kmer_ind_arrays[k], kmer_count_lens[k]))
+
+def test_fused_kernel():
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    c = plasclass.plasclass()
+    seqs = [seq for _, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    freqs = np.array([utils.kmer_frequencies(s, c._ks, c._kmer_inds, c._kmer_count_lens) for s in seqs])
+    for scale in c._scales:
+        clf = c.classifiers[scale]
+        gold = 1. / (1. + np.exp(-(c._standardize(freqs, scale).dot(clf['coef']) + clf['intercept'][0])))
+        assert np.max(np.abs(c._score(freqs, scale) - gold)) < 1e-9
+
+def test_model_bundle():
+    from plasclass import model_bundle as bundle
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(fpath,'test.pcb')
+    rng = np.random.RandomState(0)
+    models = {s: {'mean': rng.rand(10), 'scale': rng.rand(10) + 1, 'coef': rng.randn(10), 'intercept': rng.randn(1)} for s in [100,10]}
+    bundle.write_bundle(path, [2,3], models)
+    header, loaded = bundle.read_bundle(path)
+    assert header['ks'] == [2,3] and header['scales'] == [10,100] and header['n_features'] == 10
+    for s in models:
+        for a in bundle.ARRAYS:
+            assert np.array_equal(loaded[s][a], models[s][a])
+    del loaded
+    os.remove(path)
+
+def test_classify_stream():
+    import threading
+    import time
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    records = [(name, seq) for name, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    with plasclass.plasclass(2) as c:
+        probs = c.classify([seq for _, seq in records])
+        streamed = list(c.classify_stream(iter(records), max_bases=3000, chunk_bases=1000))
+        threads = threading.active_count()
+        for _ in range(3): # abandoned streams leave no reader thread behind
+            stream = c.classify_stream(iter(records), max_bases=1000, chunk_bases=500)
+            next(stream)
+            stream.close()
+        deadline = time.monotonic() + 10
+        while threading.active_count() > threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert threading.active_count() == threads
+    assert [name for name, _ in streamed] == [name for name, _ in records]
+    assert np.allclose([p for _, p in streamed], probs, rtol=0, atol=1e-12)
+
+def test_read_fastx():
+    import gzip
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    infile = os.path.join(fpath,'test.fa')
+    records = [(name, seq.encode(), qual) for name, seq, qual in utils.readfq(open(infile))]
+    gzfile = os.path.join(fpath,'test.fa.gz')
+    with open(infile,'rb') as f, gzip.open(gzfile,'wb') as o:
+        o.write(f.read())
+    assert list(utils.read_fastx(infile)) == records
+    assert list(utils.read_fastx(gzfile, block_size=1000)) == records
+    os.remove(gzfile)
+
+def test_read_fastq_memory():
+    import tempfile
+    import tracemalloc
+    from plasclass import plasclass_utils as utils
+    rng = np.random.default_rng(0)
+    fd, fqfile = tempfile.mkstemp(suffix='.fq')
+    with os.fdopen(fd, 'w') as f:
+        for i in range(20000):
+            seq = ''.join(rng.choice(list('ACGT'), 150))
+            f.write('@read{}\n{}\n+\n{}\n'.format(i, seq, 'I' * 150))
+    records = [(name, seq.encode(), qual.encode()) for name, seq, qual in utils.readfq(open(fqfile))]
+    assert list(utils.read_fastx(fqfile, block_size=1000)) == records
+    tracemalloc.start()
+    reader = utils.read_fastx(fqfile, block_size=1<<16)
+    assert next(reader) == records[0]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 8 * (1<<16) < os.path.getsize(fqfile) // 8 # only a few blocks of a multi-block file are held
+    os.remove(fqfile)
+
+def test_fasta_shards():
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    infile = os.path.join(fpath,'test.fa')
+    records = list(utils.read_fastx(infile))
+    index, _ = utils.build_fasta_index(infile)
+    assert [(entry[0], entry[1]) for entry in index] == [(name, len(seq)) for name, seq, _ in records]
+    for n_shards in [1,4]:
+        sharded = []
+        for byte_range in utils.shard_ranges(infile, n_shards):
+            sharded += list(utils.read_fastx(infile, block_size=1000, byte_range=byte_range))
+        assert sharded == records
+    os.remove(infile + '.fai')
+    import gzip
+    gzfile = os.path.join(fpath,'test_shards.fa.gz')
+    with open(infile,'rb') as f, gzip.open(gzfile,'wb') as o:
+        o.write(f.read())
+    cmd = 'python ' + os.path.join(os.path.dirname(fpath), 'classify_fasta.py') + ' -f ' + gzfile + ' -o ' + gzfile + '.out --local_shards 2'
+    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode != 0 and b'compressed' in result.stderr and b'Traceback' not in result.stderr
+    assert not os.path.exists(gzfile + '.fai')
+    os.remove(gzfile)
+
+def test_classify_windows():
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    seq = max([seq for _, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))], key=len)
+    c = plasclass.plasclass()
+    starts, ends, probs = c.classify_windows(seq, 1000, 300)
+    assert starts[0] == 0 and ends[-1] == len(seq)
+    for start, end, p in zip(starts, ends, probs):
+        assert abs(p - c.classify(seq[start:end])) < 1e-12
+    outfile = os.path.join(fpath,'test_windows.out')
+    cmd = 'python ' + os.path.join(os.path.dirname(fpath), 'classify_fasta.py') + ' -f ' + os.path.join(fpath,'test.fa') + ' -o ' + outfile + ' --window 1000'
+    for option in ['--local_shards 2', '--shard 1/2', '--merge 2', '--load_features ' + fpath]:
+        result = subprocess.run(cmd + ' ' + option, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert result.returncode != 0 and b'--window cannot be used' in result.stderr
+        assert not os.path.exists(outfile)
+    cache_dir = os.path.join(fpath,'test_windows_cache')
+    result = subprocess.run(cmd + ' --cache ' + cache_dir, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode != 0 and b'cannot be used with --window' in result.stderr
+    assert not os.path.exists(outfile) and not os.path.exists(cache_dir)
+
+def test_result_cache():
+    import shutil
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = os.path.join(fpath,'test_cache')
+    records = [(name, seq) for name, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    seqs = [seq for _, seq in records]
+    with plasclass.plasclass(2) as c:
+        probs = c.classify(seqs)
+    with plasclass.plasclass(2, cache_dir=cache_dir) as c:
+        assert np.allclose(c.classify(seqs[:30]), probs[:30], rtol=0, atol=1e-12)
+        assert c._cache.hits == 0 and c._cache.misses == 30
+        streamed = [p for _, p in c.classify_stream(iter(records), chunk_bases=1000)]
+        assert np.allclose(streamed, probs, rtol=0, atol=1e-12)
+        assert c._cache.hits == 30 and c._cache.misses == 62
+    with plasclass.plasclass(2, cache_dir=cache_dir, cache_size=10) as c:
+        assert np.array_equal(c.classify(seqs)[30:], streamed[30:])
+        assert c._cache.hits == 62
+        c.classify(['ACGTTGCA'*100])
+        assert c._cache._db.execute('SELECT COUNT(*) FROM results').fetchone()[0] == 10
+    shutil.rmtree(cache_dir)
+
+def test_training_features():
+    import multiprocessing as mp
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'plasclass'))
+    import train
+    utils = train.utils
+    infile = os.path.join(fpath,'test.fa')
+    ks = [3,4,5,6,7]
+    kmer_inds, kmer_count_lens = utils.compute_kmer_inds(ks)
+    kmer_inds = utils.kmer_ind_arrays(kmer_inds, ks)
+    n_features = sum([kmer_count_lens[k] for k in ks])
+    names, lengths = train.get_seq_lengths(infile)
+    rng = np.random.default_rng(0)
+    start_inds = {l: train.get_start_inds(names, lengths, 50, l, rng) for l in [500, 2000, 20000]}
+    for name, length in zip(names, lengths): # fragments wrapping around the end
+        if name in start_inds[2000]: start_inds[2000][name].append(length - 10)
+    seqs = train.get_all_seqs(infile, start_inds)
+    pool = mp.Pool(2, initializer=utils.init_worker, initargs=(ks, kmer_inds, kmer_count_lens))
+    stores = {}
+    for l in start_inds:
+        desc, mat = utils.create_shared_array((len(seqs[l]), n_features))
+        stores[l] = (desc, np.arange(len(seqs[l]))[::-1], mat)
+    train.featurize_fragments(pool, infile, start_inds, {l: stores[l][:2] for l in start_inds}, 2, 3000)
+    for l in start_inds:
+        expected = utils.kmer_freqs_matrix(pool, seqs[l], n_features, 10000)
+        assert np.array_equal(stores[l][2][::-1], expected)
+        utils.remove_shared_array(stores[l][0])
+    pool.close()
+    pool.join()
+
+def test_out_of_core_fit():
+    import shutil
+    import tempfile
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'plasclass'))
+    import train
+    tmp = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    labels = (rng.random(2000) < 0.5).astype(float)
+    store = np.memmap(os.path.join(tmp, 'features.f32'), dtype=np.float32, mode='w+', shape=(2000, 6))
+    store[:] = rng.normal(size=(2000, 6)) + labels[:, None]
+    scaler, clf, loss = train.fit_out_of_core(store, labels, 1000, 1, epochs=5, rng=np.random.default_rng(1))
+    holdout = slice(1800, 2000)
+    expected_scaler, expected_clf = train.fit_in_memory(np.array(store[:1800], dtype=np.float64), labels[:1800])
+    accuracy = clf.score(scaler.transform(store[holdout].astype(np.float64)), labels[holdout])
+    expected = expected_clf.score(expected_scaler.transform(store[holdout].astype(np.float64)), labels[holdout])
+    assert loss is not None and accuracy > 0.8 and abs(accuracy - expected) < 0.03
+
+    # a failed fit removes the feature stores and stops the pool
+    fit_models = train.fit_models
+    def failing_fit(*args, **kwargs):
+        raise RuntimeError('fit failed')
+    train.fit_models = failing_fit
+    infile = os.path.join(fpath,'test.fa')
+    try:
+        train.train(infile, infile, tmp, 2, lens=[1000], max_memory=50, seed=0)
+        assert False
+    except RuntimeError:
+        pass
+    finally:
+        train.fit_models = fit_models
+    assert [f for f in os.listdir(tmp) if f.startswith('features_')] == []
+    shutil.rmtree(tmp)
+
+def test_training_seed():
+    import shutil
+    import tempfile
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'plasclass'))
+    import train
+    infile = os.path.join(fpath,'test.fa')
+    names, lengths = train.get_seq_lengths(infile)
+    first, second = [train.get_start_inds(names, lengths, 100, 1000, np.random.default_rng(7)) for _ in range(2)]
+    assert first == second and first != train.get_start_inds(names, lengths, 100, 1000, np.random.default_rng(8))
+    bundles = []
+    for _ in range(2):
+        tmp = tempfile.mkdtemp()
+        train.train(infile, infile, tmp, 2, lens=[1000], seed=7)
+        with open(os.path.join(tmp, 'models.pcb'), 'rb') as f:
+            bundles.append(f.read())
+        shutil.rmtree(tmp)
+    assert bundles[0] == bundles[1]
+    # a reference exactly l long is not wrapped, so its fragments end at its end
+    assert train.fragment_names({'a': [0, 300], 'b': [0], 'c': [100]}, 1000, ['a', 'b', 'c'], [1000, 600, 2000]) == \
+        (['a:0', 'a:300', 'b:0', 'c:100'], [1000, 700, 600, 1000])
+
+def test_benchmark():
+    import tempfile
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'benchmark'))
+    import benchmark
+    fasta = tempfile.mkstemp(suffix='.fa')[1]
+    benchmark.make_fasta(fasta, {1000: 20, 10000: 5, 100000: 1, 500000: 0}, n_content=0.05)
+    seqs = [seq for _, seq, _ in utils.readfq(open(fasta))]
+    os.remove(fasta)
+    scales = [utils.get_scale(len(s), [1000,10000,100000,500000]) for s in seqs]
+    assert [scales.count(s) for s in [1000,10000,100000,500000]] == [20, 5, 1, 0]
+    assert 0 < sum([s.count('N') for s in seqs]) < 0.1 * sum([len(s) for s in seqs])
+    baseline = {'results': [{'name': 'classify_list', 'n_procs': 2, 'bases_per_sec': 100.}]}
+    _, regressions = benchmark.compare([{'name': 'classify_list', 'n_procs': 2, 'bases_per_sec': 85.}], baseline, 0.2)
+    assert not regressions
+    _, regressions = benchmark.compare([{'name': 'classify_list', 'n_procs': 2, 'bases_per_sec': 75.}], baseline, 0.2)
+    assert len(regressions) == 1
+    startup = benchmark.bench_startup(1)[0]
+    assert startup['name'] == 'startup' and startup['seconds'] == startup['import_seconds'] + startup['construct_seconds'] + startup['first_classify_seconds']
+    ballast = np.ones(300 * 2**20, dtype=np.uint8) # resident in this process, and not in the benchmark's
+    stream = benchmark.bench_isolated('classify_stream', os.path.join(fpath, 'test.fa'), 2, 1)
+    assert stream['name'] == 'classify_stream' and stream['n_procs'] == 2 and stream['sequences'] == 62
+    assert 0 < stream['peak_rss_mb'] < 300 < benchmark.peak_rss_mb()
+    del ballast
+
+def test_metrics():
+    import contextlib
+    import io
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    records = [(name, seq) for name, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    seqs = [seq for _, seq in records]
+    bases = sum([len(s) for s in seqs])
+    events = []
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), plasclass.plasclass(2, hooks=[events.append]) as c:
+        c.classify(seqs)
+        m = c.metrics.to_dict()
+        assert m['stages']['count']['sequences'] == len(seqs) and m['stages']['count']['bases'] == bases
+        assert m['stages']['partition']['bases'] == bases
+        assert sum([s['sequences'] for s in m['scales'].values()]) == len(seqs)
+        assert sum([s['bases'] for s in m['scales'].values()]) == bases
+        assert sum([e['bases'] for e in events if e['stage'] == 'score']) == bases
+        c.metrics.reset()
+        list(c.classify_stream(iter(records), chunk_bases=1000))
+        m = c.metrics.to_dict()
+        for stage in ['parse', 'count', 'score']:
+            assert m['stages'][stage]['sequences'] == len(seqs) and m['stages'][stage]['bases'] == bases
+        assert m['stages']['partition']['calls'] == 0
+        assert sum([s['bases'] for s in m['scales'].values()]) == bases
+    assert output.getvalue() == ''
+
+def test_server():
+    import gzip
+    import json
+    import tempfile
+    import threading
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    from plasclass import server
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    infile = os.path.join(fpath,'test.fa')
+    records = [(name, seq) for name, seq, _ in utils.readfq(open(infile))]
+    parts = [records[i::4] for i in range(4)]
+    tmpdir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmpdir, 'plasclass.sock')
+    with plasclass.plasclass(2) as c:
+        probs = dict(zip([name for name, _ in records], c.classify([seq for _, seq in records])))
+        s = server.make_server(c, socket_path, max_wait=0.5)
+        serving = threading.Thread(target=s.serve_forever)
+        serving.start()
+        try:
+            responses = [None] * len(parts)
+            def request(i):
+                fasta = ''.join(['>{}\n{}\n'.format(name, seq) for name, seq in parts[i]]).encode()
+                responses[i] = server.classify_remote(data=gzip.compress(fasta) if i == 0 else fasta, socket_path=socket_path)
+            clients = [threading.Thread(target=request, args=(i,)) for i in range(len(parts))]
+            for t in clients: t.start()
+            for t in clients: t.join()
+            assert s.batcher.n_batches == 1
+            for part, response in zip(parts, responses):
+                lines = [line.split('\t') for line in response.decode().splitlines()]
+                assert [name for name, _ in lines] == [name for name, _ in part]
+                assert np.allclose([float(p) for _, p in lines], [probs[name] for name, _ in part], rtol=0, atol=1e-12)
+            outfile = os.path.join(tmpdir, 'test.out')
+            cmd = 'python ' + os.path.join(os.path.dirname(fpath), 'classify_client.py') + ' -f ' + infile + ' -o ' + outfile + ' -s ' + socket_path
+            subprocess.check_call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with open(outfile) as f:
+                lines = [line.split('\t') for line in f.read().splitlines()]
+            assert [name for name, _ in lines] == [name for name, _ in records]
+            assert np.allclose([float(p) for _, p in lines], [probs[name] for name, _ in records], rtol=0, atol=1e-12)
+            metrics_json = os.path.join(tmpdir, 'metrics.json')
+            subprocess.check_call(cmd + ' --columns length,scale --digits 4 --cache ' + tmpdir + ' --precision float32'
+                                  + ' --metrics_json ' + metrics_json, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with open(outfile) as f:
+                lines = [line.split('\t') for line in f.read().splitlines()]
+            assert [(name, int(l), int(scale)) for name, _, l, scale in lines] == [(name, len(seq), c._get_scale(len(seq))) for name, seq in records]
+            assert np.allclose([float(p) for _, p, _, _ in lines], [probs[name] for name, _ in records], rtol=1e-3, atol=0)
+            with open(metrics_json) as f:
+                assert 'stages' in json.load(f)
+            os.remove(metrics_json)
+            subprocess.check_call(cmd + ' --window 500 --step 250', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            windows = list(c.classify_windows_stream(iter(records), 500, 250))
+            with open(outfile) as f:
+                assert f.read() == ''.join(['{}\t{}\t{}\t{}\n'.format(name, start, end, p)
+                                            for name, (starts, ends, ps) in windows for start, end, p in zip(starts, ends, ps)])
+            try:
+                server.classify_remote(os.path.join(tmpdir, 'missing.fa'), socket_path=socket_path)
+                assert False
+            except RuntimeError as e:
+                assert '400' in str(e)
+            assert b'"stages"' in server.request('GET', '/metrics', socket_path=socket_path)
+        finally:
+            s.shutdown()
+            serving.join()
+            server.close_server(s)
+    assert not os.path.exists(socket_path)
+    os.remove(outfile)
+    os.rmdir(tmpdir)
+
+def test_aclassify_stream():
+    import asyncio
+    import shutil
+    import tempfile
+    import threading
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    records = [(name, seq) for name, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    async def source():
+        for record in records:
+            await asyncio.sleep(0)
+            yield record
+    async def run(c):
+        ticks = [0]
+        async def ticker():
+            while True:
+                ticks[0] += 1
+                await asyncio.sleep(0)
+        t = asyncio.ensure_future(ticker())
+        streamed = [name_prob async for name_prob in c.aclassify_stream(source(), max_bases=3000, chunk_bases=1000)]
+        t.cancel()
+        return streamed, ticks[0]
+    with plasclass.plasclass(2) as c:
+        probs = c.classify([seq for _, seq in records])
+        streamed, ticks = asyncio.run(run(c))
+    assert ticks > len(records)
+    assert [name for name, _ in streamed] == [name for name, _ in records]
+    assert np.allclose([p for _, p in streamed], probs, rtol=0, atol=1e-12)
+    cache_dir = tempfile.mkdtemp()
+    with plasclass.plasclass(2, cache_dir=cache_dir) as c:
+        threads = []
+        get_many = c._cache.get_many
+        def recording_get_many(keys):
+            threads.append(threading.current_thread())
+            return get_many(keys)
+        c._cache.get_many = recording_get_many
+        for _ in range(2): # filling the cache, then reading it
+            streamed, _ = asyncio.run(run(c))
+            assert [name for name, _ in streamed] == [name for name, _ in records]
+            assert np.allclose([p for _, p in streamed], probs, rtol=0, atol=1e-12)
+        assert threads and threading.main_thread() not in threads
+    shutil.rmtree(cache_dir)
+    async def abandon(c):
+        stream = c.aclassify_stream(source(), chunk_bases=500)
+        async for _ in stream:
+            break
+        await stream.aclose()
+    with plasclass.plasclass(2) as c:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(abandon(c))
+        loop.close() # with chunks still in the pool
+        result = []
+        t = threading.Thread(target=lambda: result.append(c.classify([seq for _, seq in records])))
+        t.daemon = True
+        t.start()
+        t.join(60)
+        assert result and np.allclose(result[0], probs, rtol=0, atol=1e-12)
+
+def test_float32():
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    outfile = os.path.join(fpath,'test.out')
+    cmd = 'python ' + os.path.join(os.path.dirname(fpath), 'classify_fasta.py') + ' -f ' + os.path.join(fpath,'test.fa') + ' -o ' + outfile + ' --precision float32'
+    subprocess.check_call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(os.path.join(fpath,'test.gs')) as f:
+        gs = [(line.split()[0], float(line.split()[1])) for line in f]
+    with open(outfile) as f:
+        out = [(line.split()[0], float(line.split()[1])) for line in f]
+    os.remove(outfile)
+    assert [name for name, _ in out] == [name for name, _ in gs]
+    assert np.max(np.abs(np.array([p for _, p in out]) - [p for _, p in gs])) < 1e-5
+    seqs = [seq for _, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    with plasclass.plasclass(2, dtype=np.float32) as c:
+        assert np.max(np.abs(c.classify(seqs) - [p for _, p in gs])) < 1e-5
+        assert abs(c.classify(seqs[0]) - gs[0][1]) < 1e-5
+        assert utils.kmer_freqs_matrix(c._get_pool(), seqs[:5], c._n_features, 1000, np.float32).dtype == np.float32
+
+def test_length_aware_batching():
+    from plasclass import plasclass
+    from plasclass import plasclass_utils as utils
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    seqs = [seq for _, seq, _ in utils.readfq(open(os.path.join(fpath,'test.fa')))]
+    rng = np.random.RandomState(0)
+    for length in [30000, 200000]: # long sequences with runs of ambiguous bases, split into pieces
+        seq = rng.choice(list('ACGTacgt'), length)
+        for start in rng.randint(0, length - 20, 20):
+            seq[start:start+rng.randint(1,12)] = 'N'
+        seqs.insert(len(seqs)//2, ''.join(seq))
+    lengths = [len(s) for s in seqs]
+    tasks = utils.schedule_chunks(lengths, 10000)
+    pieces = [t for t in tasks if t[0] == 'piece']
+    assert [t[1] for t in pieces[:20]] == [lengths.index(200000)] * 20 and pieces[0] == tasks[0]
+    rows = np.concatenate([t[1] for t in tasks if t[0] == 'rows'])
+    assert sorted(list(rows) + list(set(t[1] for t in pieces))) == list(range(len(seqs)))
+    assert list(np.array(lengths)[rows]) == sorted(np.array(lengths)[rows], reverse=True)
+    bounds = utils.batch_bounds(lengths, 7, 60000, 1000)
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(seqs)
+    for first, last in bounds:
+        assert last - first <= 7 and (last - first == 1 or sum(lengths[first:last]) + 1000 * (last - first) <= 60000)
+    with plasclass.plasclass(2, batch_size=7, max_memory=1) as c:
+        expected = np.array([utils.kmer_frequencies(s, c._ks, c._kmer_inds, c._kmer_count_lens) for s in seqs])
+        assert np.array_equal(utils.kmer_freqs_matrix(c._get_pool(), seqs, c._n_features, 10000), expected)
+        probs = c.classify(seqs)
+    assert np.allclose(probs, [c.classify(s) for s in seqs], rtol=0, atol=1e-12)
+
+def test_kmer_index_tables():
+    import itertools
+    from plasclass import plasclass_utils as utils
+    for k in range(1, 7): # the tables of the original string construction
+        kmer_inds, n = {}, 0
+        for kmer in sorted([''.join(kmer) for kmer in itertools.product('ACGT', repeat=k)]):
+            rc_bit_mer = utils.mer2bits(utils.get_rc(kmer))
+            if rc_bit_mer in kmer_inds:
+                kmer_inds[utils.mer2bits(kmer)] = kmer_inds[rc_bit_mer]
+            else:
+                kmer_inds[utils.mer2bits(kmer)] = n
+                n += 1
+        table, vec_len = utils.kmer_index_table(k)
+        assert table.dtype == np.int32 and vec_len == n
+        assert table.tolist() == [kmer_inds[b] for b in range(4**k)]
+        assert utils.compute_kmer_inds([k]) == ({k: kmer_inds}, {k: n})
+    table, vec_len = utils.kmer_index_table(11)
+    assert len(table) == 4**11 and vec_len == 4**11 // 2 and table.max() == vec_len - 1
+    codes = np.random.RandomState(0).randint(0, 4**11, 1000)
+    rc = np.zeros_like(codes)
+    for j in range(11):
+        rc = (rc << 2) | (3 - ((codes >> 2*j) & 3))
+    assert np.array_equal(table[codes], table[rc])
+    assert utils.kmer_index_table(11)[0] is table and not table.flags.writeable
+
+def test_lazy_loading():
+    import pickle
+    from plasclass import plasclass
+    script = ('import sys; from plasclass import plasclass; c = plasclass.plasclass(); c.classify("ACGT" * 250); '
+              'print(c.classifiers.loaded(), "asyncio" in sys.modules, "sqlite3" in sys.modules)')
+    output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+    assert output.decode().split() == ['[1000]', 'False', 'False']
+    c = plasclass.plasclass()
+    assert c.classifiers.loaded() == [] and list(c.classifiers) == [1000,10000,100000,500000]
+    kernels = pickle.loads(pickle.dumps(c._kernels()))
+    assert list(kernels) == [1000,10000,100000,500000] and kernels._models.loaded() == []
+    assert np.array_equal(kernels[10000][0], c.classifiers[10000]['weights'])
+    assert kernels._models.loaded() == [10000] and c.classifiers.loaded() == [10000]
+
+def test_feature_store():
+    import shutil
+    import tempfile
+    from plasclass import plasclass
+    from plasclass import feature_store
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp()
+    script = 'python ' + os.path.join(os.path.dirname(fpath), 'classify_fasta.py')
+    infile = os.path.join(fpath,'test.fa')
+    features_dir = os.path.join(tmp, 'features{0}') # not a format string
+    cmd = script + ' -f ' + infile + ' -o ' + os.path.join(tmp, 'saved.out') + ' --save-features ' + features_dir
+    subprocess.check_call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cmd = script + ' --load-features ' + features_dir + ' -o ' + os.path.join(tmp, 'loaded.out')
+    subprocess.check_call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    out = {}
+    for name in ['saved', 'loaded']:
+        with open(os.path.join(tmp, name + '.out')) as f:
+            out[name] = [(line.split()[0], float(line.split()[1])) for line in f]
+    assert [name for name, _ in out['loaded']] == [name for name, _ in out['saved']]
+    assert np.allclose([p for _, p in out['loaded']], [p for _, p in out['saved']], rtol=0, atol=1e-12)
+    store = feature_store.FeatureStore(features_dir)
+    seqs = dict((name, seq) for name, seq, _ in plasclass.utils.read_fastx(infile))
+    with plasclass.plasclass(1) as c:
+        for scale in store.scales:
+            names, matrix = store.names(scale), store.matrix(scale)
+            assert isinstance(matrix, np.memmap) and len(names) == store.rows(scale) == len(matrix)
+            assert list(store.lengths(scale)) == [len(seqs[name]) for name in names]
+            assert np.array_equal(matrix[0], plasclass.utils.kmer_frequencies(seqs[names[0]], c._ks, c._kmer_inds, c._kmer_count_lens))
+        with_scales = plasclass.plasclass(1, scales=[1000, 10000, 100000])
+        assert np.allclose([p for _, p in with_scales.classify_features(store)], with_scales.classify(list(seqs.values())), atol=1e-12)
+        with_scales.close()
+    with open(os.path.join(features_dir, 'notes.txt'), 'w') as f:
+        f.write('not part of the store')
+    writer = feature_store.FeatureWriter(features_dir, [3], 2) # rewritten with fewer scales and chunks
+    writer.add_matrix(1000, np.zeros((2, 2)), ['a', 'b'], [1000, 1000])
+    writer.close()
+    assert sorted(os.listdir(features_dir)) == ['1000.0.npy', '1000.lengths.npy', '1000.names', 'features.json', 'notes.txt']
+
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'plasclass'))
+    import train
+    names, lengths = train.get_seq_lengths(infile)
+    start_inds = {l: train.get_start_inds(names, lengths, 20, l, np.random.default_rng(0)) for l in [500, 2000]}
+    features, fragments = {}, {}
+    for l in start_inds:
+        fragments[l] = train.fragment_names(start_inds[l], l, names, lengths)
+        rows = np.random.default_rng(l).permutation(len(fragments[l][0]))
+        features[l] = (None, np.random.default_rng(l).random((len(rows), 8)), (rows % 2).astype(float), rows)
+    train.save_fragment_features(os.path.join(tmp, 'train'), [3], 8, features, fragments)
+    loaded = train.load_fragment_features(os.path.join(tmp, 'train'), [3], [500, 2000])
+    store = feature_store.FeatureStore(os.path.join(tmp, 'train'))
+    for l in start_inds:
+        assert np.array_equal(loaded[l][1], features[l][1]) and np.array_equal(loaded[l][2], features[l][2])
+        assert store.names(l)[features[l][3][0]] == fragments[l][0][0]
+        assert store.lengths(l)[features[l][3][-1]] == fragments[l][1][-1]
+    shuffled = train.load_fragment_features(os.path.join(tmp, 'train'), [3], [500, 2000], tmp, np.random.default_rng(1), block_rows=7)
+    rng = np.random.default_rng(1)
+    for l in start_inds: # shuffled for training out of core
+        rows = rng.permutation(len(loaded[l][1]))
+        assert shuffled[l][1].dtype == np.float32 and np.array_equal(shuffled[l][1], loaded[l][1][rows].astype(np.float32))
+        assert np.array_equal(shuffled[l][2], loaded[l][2][rows])
+    train.remove_features(shuffled)
+    assert not [f for f in os.listdir(tmp) if f.startswith('features_')]
+    shutil.rmtree(tmp)
+
+def test_parallel_fitting():
+    import multiprocessing as mp
+    import time
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(os.path.dirname(fpath), 'plasclass'))
+    import train
+    rng = np.random.default_rng(0)
+    features = {}
+    for l in [1000, 10000]:
+        desc, data = train.utils.create_shared_array((200, 6))
+        labels = (np.arange(200) < 100).astype(float)
+        data[:] = rng.normal(size=(200, 6)) + labels[:, None]
+        features[l] = (desc, data, labels, None)
+    pool = mp.Pool(2)
+    fitted = train.fit_models(pool, features, [1000, 10000])
+    for l in features:
+        scaler, clf = train.fit_in_memory(np.array(features[l][1]), features[l][2])
+        assert np.array_equal(fitted[l][0].mean_, scaler.mean_) and np.array_equal(fitted[l][1].coef_, clf.coef_)
+    swept = train.fit_models(pool, features, [1000, 10000], Cs=[1e-4, 1.], cv=3, rng=np.random.default_rng(1))
+    for l in features: # barely regularized models fit the shifted classes better
+        assert swept[l][1].C == 1.
+    bounded = train.fit_models(pool, features, [1000, 10000], Cs=[1e-4, 1.], cv=3, rng=np.random.default_rng(1), fit_procs=1)
+    for l in features:
+        assert np.array_equal(bounded[l][1].coef_, swept[l][1].coef_)
+    start = time.perf_counter()
+    tasks = train.BoundedTasks(pool, 1)
+    assert [f.result() for f in [tasks.submit(time.sleep, (0.1,)) for _ in range(3)]] == [None] * 3
+    assert time.perf_counter() - start >= 0.3 # one at a time in a pool of two
+    pool.close()
+    pool.join()
+    for l in features:
+        train.utils.remove_shared_array(features[l][0])
+
+def test_result_writer():
+    import gzip
+    import shutil
+    import tempfile
+    from plasclass import result_writer
+    tmp = tempfile.mkdtemp()
+    names = ['seq{}'.format(i) for i in range(25)]
+    probs = np.random.default_rng(0).random(25)
+    probs[0] = 1e-7
+    for format in result_writer.FORMATS:
+        with result_writer.ResultWriter(os.path.join(tmp, format), format, block_records=10) as w:
+            for name, p in zip(names, probs):
+                w.add(name, p)
+    expected = ''.join([name + '\t' + str(p) + '\n' for name, p in zip(names, probs)])
+    with open(os.path.join(tmp, 'tsv')) as f:
+        assert f.read() == expected
+    with gzip.open(os.path.join(tmp, 'tsv.gz'), 'rt') as f:
+        assert f.read() == expected
+    read_names, read_probs, columns = result_writer.read_binary(os.path.join(tmp, 'binary'))
+    assert read_names == names and columns == {}
+    assert read_probs.dtype == np.float32 and np.array_equal(read_probs, probs.astype(np.float32))
+    with result_writer.ResultWriter(os.path.join(tmp, 'columns'), 'binary', columns=['length', 'scale']) as w:
+        for i, (name, p) in enumerate(zip(names, probs)):
+            w.add(name, p, i*1000, 1000)
+    _, _, columns = result_writer.read_binary(os.path.join(tmp, 'columns'))
+    assert list(columns['length']) == [i*1000 for i in range(25)] and set(columns['scale']) == {1000}
+    with result_writer.ResultWriter(os.path.join(tmp, 'digits'), digits=3, columns=['length']) as w:
+        w.add('seq', 0.123456, 5)
+    with open(os.path.join(tmp, 'digits')) as f:
+        assert f.read() == 'seq\t0.123\t5\n'
+    fpath = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(fpath))
+    import classify_fasta
+    from plasclass import plasclass
+    records = [(name, seq) for name, seq, _ in plasclass.utils.readfq(open(os.path.join(fpath, 'test.fa')))]
+    with plasclass.plasclass(1) as c: # without output options
+        classify_fasta.classify_records(c, os.path.join(fpath, 'test.fa'), os.path.join(tmp, 'default'), 100000000)
+        probs = c.classify([seq for _, seq in records])
+    with open(os.path.join(tmp, 'default')) as f:
+        lines = [line.split('\t') for line in f.read().splitlines()]
+    assert [name for name, _ in lines] == [name for name, _ in records]
+    assert np.allclose([float(p) for _, p in lines], probs, rtol=0, atol=1e-12)
+    shutil.rmtree(tmp)
+
 def all_tests():
     print("Testing...")
     test_fasta_classifier()
     test_module()
+    test_count_kmers_equivalence()
+    test_fused_kernel()
+    test_model_bundle()
+    test_classify_stream()
+    test_read_fastx()
+    test_read_fastq_memory()
+    test_fasta_shards()
+    test_classify_windows()
+    test_result_cache()
+    test_training_features()
+    test_out_of_core_fit()
+    test_training_seed()
+    test_benchmark()
+    test_metrics()
+    test_server()
+    test_aclassify_stream()
+    test_float32()
+    test_length_aware_batching()
+    test_kmer_index_tables()
+    test_lazy_loading()
+    test_feature_store()
+    test_parallel_fitting()
+    test_result_writer()
     print("Passed all tests")
 
 if __name__=='__main__':